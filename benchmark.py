@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""Benchmarks for overdrive-dl against a local stand-in for the OverDrive
+servers. Synthetic ODM files point at the stand-in, which serves licenses,
+covers and parts with configurable latency, bandwidth, failures and Range
+support. Each benchmark runs in its own process so that its CPU time and
+peak RSS are not mixed up with the others'."""
+
+import argparse
+import http.server
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from os.path import abspath, dirname, getsize, join
+
+SCRIPT_PATH = join(dirname(abspath(__file__)), 'overdrive-dl.py')
+BENCHMARKS = ('parse', 'load_cached', 'download', 'tags')
+PATTERN = bytes(range(256)) * 256
+WRITE_SIZE = 16384
+LICENSE = ('<License xmlns="http://license.overdrive.com/2008/03/License.xsd">'
+        '<SignedInfo><ClientID>BENCHMARK</ClientID></SignedInfo></License>')
+ODM_TEMPLATE = '''<?xml version="1.0" encoding="utf-8" ?>
+<OverDriveMedia id="{media_id}" ODMVersion="3.0.0.0">
+<License><AcquisitionUrl>{server}/license</AcquisitionUrl></License><![CDATA[<Metadata><ContentType>Audiobook</ContentType><Title>{title}</Title><Creators><Creator role="Author" file-as="Author, Bench">Bench Author</Creator><Creator role="Narrator">Bench Narrator</Creator></Creators><Publisher>Bench Publisher</Publisher><Subjects><Subject id="1">Fiction</Subject><Subject id="2">Mystery</Subject></Subjects><Languages><Language code="en">English</Language></Languages><CoverUrl>{server}/cover.jpg</CoverUrl><Description>{description}</Description></Metadata>]]><Formats><Format name="MP3 Format"><Protocols><Protocol method="download" baseurl="{server}/parts" /></Protocols><Parts count="{num_parts}">{parts}</Parts></Format></Formats><Source><Name>Bench Library</Name></Source><ExpirationDate>{expiration}</ExpirationDate></OverDriveMedia>
+'''
+PART_TEMPLATE = ('<Part number="{number}" filename="{filename}"'
+        ' name="{title} - Part {number:02d}" filesize="{filesize}"'
+        ' duration="00:{minutes:02d}:00" />')
+
+
+class MockServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0, bandwidth=0, failure_rate=0, ranges=True,
+            seed=0):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.ranges = ranges
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # part filename -> size, registered by write_odm
+        self.parts = {}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def failure(self):
+        # None, or how the next request should fail
+        with self.lock:
+            if self.random.random() >= self.failure_rate:
+                return None
+            return self.random.choice(('status', 'break'))
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.path.startswith('/license'):
+            return self.send_body(200, LICENSE.encode('utf-8'))
+        if self.path.startswith('/cover'):
+            return self.send_body(200, PATTERN[:32768])
+        m = re.match(r'^/parts/(.+)$', self.path)
+        if not m or m.group(1) not in self.server.parts:
+            return self.send_body(404, b'')
+        size = self.server.parts[m.group(1)]
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and self.server.ranges:
+            m = re.match(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else size - 1
+            status = 206
+        failure = self.server.failure()
+        if failure == 'status':
+            return self.send_body(503, b'busy', {'Retry-After': '0'})
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range',
+                    'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+        # A failing request breaks off halfway through the body
+        stop = start + (end - start + 1) // 2 if failure else end + 1
+        self.send_pattern(start, stop)
+        if failure:
+            self.close_connection = True
+
+    def send_body(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_pattern(self, start, stop):
+        offset = start
+        start_time = time.monotonic()
+        while offset < stop:
+            begin = offset % len(PATTERN)
+            chunk = PATTERN[begin:begin + min(WRITE_SIZE, stop - offset)]
+            try:
+                self.wfile.write(chunk)
+            except OSError:
+                return
+            offset += len(chunk)
+            if self.server.bandwidth:
+                # Sleep until the bytes sent so far are due
+                delay = (offset - start) / self.server.bandwidth \
+                        - (time.monotonic() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def write_odm(path, server, number, num_parts, part_size,
+        description_size=2000):
+    """Writes a synthetic ODM file with num_parts parts of part_size bytes
+    served by server, and returns its path."""
+    title = 'Bench Book {}'.format(number)
+    filename_prefix = 'BenchBook{}'.format(number)
+    parts = []
+    for part_number in range(1, num_parts + 1):
+        filename = '{}-Part{:02d}.mp3'.format(filename_prefix, part_number)
+        server.parts[filename] = part_size
+        parts.append(PART_TEMPLATE.format(
+            number=part_number,
+            filename=filename,
+            title=title,
+            filesize=part_size,
+            minutes=part_number % 60))
+    sentence = '&lt;p&gt;A synthetic description of a benchmark book.&lt;/p&gt;'
+    with open(path, 'w') as fd:
+        fd.write(ODM_TEMPLATE.format(
+            media_id='{{{}}}'.format(str(uuid.uuid4()).upper()),
+            server=server.url,
+            title=title,
+            description=sentence * max(1, description_size // len(sentence)),
+            num_parts=num_parts,
+            parts=''.join(parts),
+            expiration=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                time.gmtime(time.time() + 14 * 86400))))
+    return path
+
+
+def load_overdrive_dl(workdir, jobs):
+    # The script's name is not a valid module name, so load it by path
+    spec = importlib.util.spec_from_file_location('overdrive_dl', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.CLIENT_ID_PATH = join(workdir, 'clientid')
+    module.config = {
+            'download_dir': join(workdir, 'library'),
+            'filenames_lowercase': True,
+            'cache_dir': join(workdir, 'cache'),
+            'jobs': jobs,
+            'http': {'backoff': 0.05, 'backoff_max': 1}}
+    module._setup_session(jobs)
+    return module
+
+
+def run_benchmark(name, args):
+    """Runs one benchmark in this process and returns its measurements."""
+    logging.basicConfig(level=logging.WARNING)
+    odm_filenames = sorted(join(args.workdir, f)
+            for f in os.listdir(args.workdir) if f.endswith('.odm'))
+    od = load_overdrive_dl(args.workdir, args.jobs)
+    if name == 'parse':
+        def fn():
+            for _ in range(args.parse_iterations):
+                for odm_filename in odm_filenames:
+                    book = od._parse_odm(odm_filename)
+                    od._extract_metadata(book)
+                    od._extract_author_title_urls_parts(book)
+            return args.parse_iterations * len(odm_filenames), 'files'
+    elif name == 'load_cached':
+        for odm_filename in odm_filenames:
+            od._load_book(odm_filename)
+
+        def fn():
+            for _ in range(args.parse_iterations):
+                for odm_filename in odm_filenames:
+                    # Drop the in-memory copy so the on-disk cache is read
+                    od._books.clear()
+                    od._load_book(odm_filename)
+            return args.parse_iterations * len(odm_filenames), 'files'
+    elif name == 'download':
+        shutil.rmtree(od.config['download_dir'], ignore_errors=True)
+
+        def fn():
+            downloaded_bytes = 0
+            for odm_filename in odm_filenames:
+                downloaded_bytes += od.download_audiobook(odm_filename,
+                        jobs=args.jobs)
+            return downloaded_bytes, 'bytes'
+    elif name == 'tags':
+        # Tags the parts left behind by the download benchmark, with a new
+        # value every run so every file is actually rewritten
+        tags = {'genre': 'Audiobook', 'version': str(uuid.uuid4())}
+        books = []
+        for odm_filename in odm_filenames:
+            book = od._load_book(odm_filename)
+            author, title, _, _, parts = \
+                    od._extract_author_title_urls_parts(book)
+            download_dir = od._construct_download_dir_path(author, title)
+            od._die_if_missing_files(download_dir, len(parts))
+            books.append((book, download_dir))
+
+        def fn():
+            tagged_bytes = 0
+            for book, download_dir in books:
+                od._update_tags(tags, book, download_dir, args.jobs)
+                tagged_bytes += sum(getsize(join(download_dir, f))
+                        for f in os.listdir(download_dir)
+                        if f.endswith('.mp3'))
+            return tagged_bytes, 'bytes'
+    else:
+        raise ValueError('Unknown benchmark {}'.format(name))
+    start_rss = _peak_rss()
+    start_cpu = time.process_time()
+    start_time = time.perf_counter()
+    amount, unit = fn()
+    wall = time.perf_counter() - start_time
+    return {'benchmark': name,
+            'wall': wall,
+            'cpu': time.process_time() - start_cpu,
+            'amount': amount,
+            'unit': unit,
+            'start_rss': start_rss,
+            'peak_rss': _peak_rss()}
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _parse_size(size):
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', size, re.I)
+    if not m:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(size))
+    return int(float(m.group(1)) * 1024 ** ' KMG'.index(
+        m.group(2).upper() or ' '))
+
+
+def _format_size(num_bytes):
+    return '{:.1f}MB'.format(num_bytes / (1024.0*1024.0))
+
+
+def _format_throughput(result):
+    rate = result['amount'] / max(result['wall'], 1e-9)
+    if result['unit'] == 'bytes':
+        return '{}/s'.format(_format_size(rate))
+    return '{:.0f} {}/s'.format(rate, result['unit'])
+
+
+def _summarize(results):
+    # Median of the repeated runs of each benchmark
+    summary = []
+    for name in BENCHMARKS:
+        runs = [r for r in results if r['benchmark'] == name]
+        if not runs:
+            continue
+        summary.append({
+            'benchmark': name,
+            'runs': len(runs),
+            'wall': statistics.median(r['wall'] for r in runs),
+            'wall_min': min(r['wall'] for r in runs),
+            'cpu': statistics.median(r['cpu'] for r in runs),
+            'amount': runs[0]['amount'],
+            'unit': runs[0]['unit'],
+            'peak_rss': max(r['peak_rss'] for r in runs)})
+    return summary
+
+
+def _print_summary(summary):
+    row = '{:<12} {:>5} {:>10} {:>10} {:>10} {:>16} {:>10}'
+    print(row.format('benchmark', 'runs', 'wall', 'min wall', 'cpu',
+        'throughput', 'peak rss'))
+    for result in summary:
+        print(row.format(
+            result['benchmark'],
+            result['runs'],
+            '{:.3f}s'.format(result['wall']),
+            '{:.3f}s'.format(result['wall_min']),
+            '{:.3f}s'.format(result['cpu']),
+            _format_throughput(result),
+            _format_size(result['peak_rss'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark overdrive-dl'
+            ' against a local mock of the OverDrive servers')
+    parser.add_argument(
+            '-b', '--benchmarks', default=','.join(BENCHMARKS),
+            help='Comma separated benchmarks to run, from {}'
+            ' (default: all)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument(
+            '--books', type=int, default=1, help='Number of books')
+    parser.add_argument(
+            '--parts', type=int, default=8, help='Number of parts per book')
+    parser.add_argument(
+            '--part-size', type=_parse_size, default='8M',
+            help='Size of every part, with an optional K, M or G suffix')
+    parser.add_argument(
+            '-j', '--jobs', type=int, default=4,
+            help='Parts downloaded and tagged at the same time')
+    parser.add_argument(
+            '--latency', type=float, default=0.0,
+            help='Seconds the server waits before answering each request')
+    parser.add_argument(
+            '--bandwidth', type=_parse_size, default='0',
+            help='Bytes per second the server sends on each connection,'
+            ' 0 for no limit')
+    parser.add_argument(
+            '--failure-rate', type=float, default=0.0,
+            help='Fraction of part requests that fail, half of them with'
+            ' a 503 and half breaking off midway')
+    parser.add_argument(
+            '--no-range', dest='ranges', action='store_false',
+            help='Ignore Range requests like a server without resume support')
+    parser.add_argument(
+            '--parse-iterations', type=int, default=200,
+            help='Times each ODM file is parsed in the parsing benchmarks')
+    parser.add_argument(
+            '-r', '--repeat', type=int, default=3,
+            help='Runs of each benchmark, the median is reported')
+    parser.add_argument(
+            '--json', metavar='FILE',
+            help='Also write every run and the summary to FILE as JSON')
+    parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the working directory with the ODM files and'
+            ' downloads')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        result = run_benchmark(args.run, args)
+        with open(args.result, 'w') as fd:
+            json.dump(result, fd)
+        return
+
+    names = [name.strip() for name in args.benchmarks.split(',')]
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+    server = MockServer(latency=args.latency,
+            bandwidth=args.bandwidth,
+            failure_rate=args.failure_rate,
+            ranges=args.ranges).start()
+    workdir = tempfile.mkdtemp(prefix='overdrive-dl-bench-')
+    for number in range(1, args.books + 1):
+        write_odm(join(workdir, 'book{}.odm'.format(number)), server, number,
+                args.parts, args.part_size)
+    print('{} book(s) of {} parts of {} served from {} (latency {}s,'
+            ' bandwidth {}, failure rate {}, ranges {})'.format(
+                args.books, args.parts, _format_size(args.part_size),
+                server.url, args.latency,
+                _format_size(args.bandwidth) + '/s' if args.bandwidth
+                else 'unlimited',
+                args.failure_rate,
+                'on' if args.ranges else 'off'))
+    results = []
+    try:
+        # tags works on the parts downloaded by the download benchmark
+        if 'tags' in names and 'download' not in names:
+            names.insert(names.index('tags'), 'download')
+            warmup_only = True
+        else:
+            warmup_only = False
+        for name in names:
+            repeat = 1 if name == 'download' and warmup_only else args.repeat
+            for _ in range(repeat):
+                result_path = join(workdir, 'result.json')
+                # Child output is the progress display, which is not useful
+                # here
+                subprocess.run([sys.executable, abspath(__file__),
+                        '--run', name,
+                        '--workdir', workdir,
+                        '--result', result_path,
+                        '--jobs', str(args.jobs),
+                        '--parse-iterations', str(args.parse_iterations)],
+                        stdout=subprocess.DEVNULL, check=True)
+                with open(result_path, 'r') as fd:
+                    result = json.load(fd)
+                if not (name == 'download' and warmup_only):
+                    results.append(result)
+        summary = _summarize(results)
+        _print_summary(summary)
+        if args.json:
+            with open(args.json, 'w') as fd:
+                json.dump({'options': {
+                            'books': args.books,
+                            'parts': args.parts,
+                            'part_size': args.part_size,
+                            'jobs': args.jobs,
+                            'latency': args.latency,
+                            'bandwidth': args.bandwidth,
+                            'failure_rate': args.failure_rate,
+                            'ranges': args.ranges},
+                        'runs': results,
+                        'summary': summary}, fd, indent=2)
+    finally:
+        server.shutdown()
+        if args.keep:
+            print('Kept working directory {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,42 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import base64
+import cProfile
+import csv
+import functools
+import glob
 import grp
 import hashlib
+import heapq
+import json
 import logging
-import math
 import os
 import pwd
+import random
 import re
+import sqlite3
+import stat
 import sys
+import threading
 import time
 import uuid
 import xml.etree.ElementTree as ET 
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+        as_completed, wait)
+from datetime import datetime
+from http import HTTPStatus
 from xml.parsers.expat import ExpatError
 
-import requests
+from os.path import (abspath, basename, dirname, expanduser, getmtime,
+        getsize, isdir, isfile, join, normpath, realpath, sep)
+from urllib.parse import parse_qsl, urlparse
 
-from os.path import (abspath, basename, dirname, expanduser, getsize, isdir,
-        isfile, join, normpath, realpath, sep)
-from mutagen.easyid3 import EasyID3
-
-# Optional support for printing formatted descriptions
-try:
-    from prompt_toolkit import print_formatted_text, HTML
-except (ModuleNotFoundError, ImportError):
-    print_formatted_text = print
-    HTML = lambda x: x
+# requests, urllib3 and mutagen are imported by the functions that use them,
+# so that printing metadata does not have to load them
 
 CONFIG_FILE = join(dirname(realpath(__file__)), 'config.toml')
 config = {'download_dir': '~/Documents/audiobooks/',
@@ -46,38 +56,226 @@ CLIENT_ID_PATH = expanduser('~/.overdrive-dl.clientid')
 DOWNLOAD_PATH_FORMAT = '{author}/{title}/{filename}'
 DOWNLOAD_FILENAME_FORMAT = 'part{number:02d}.mp3'
 COVER_FILENAME_FORMAT = '{title}.jpg'
-CHUNK_SIZE = 1024
+MERGED_FILENAME_FORMAT = '{title}.mp3'
+PARTIAL_SUFFIX = '.partial'
+PARTIAL_STATE_SUFFIX = '.state'
+PARTIAL_CHECKPOINT_BYTES = 8*1024*1024
+MANIFEST_FILENAME = '.overdrive-dl.json'
+MANIFEST_VERSION = 1
+INDEX_FILENAME = 'library.db'
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    media_id TEXT PRIMARY KEY,
+    odm TEXT,
+    author TEXT,
+    title TEXT,
+    path TEXT,
+    num_parts INTEGER,
+    expiration_date TEXT,
+    tags_updated REAL,
+    owner_updated REAL,
+    updated REAL);
+CREATE TABLE IF NOT EXISTS parts (
+    media_id TEXT REFERENCES books (media_id),
+    number INTEGER,
+    filename TEXT,
+    expected_size INTEGER,
+    size INTEGER,
+    sha256 TEXT,
+    complete INTEGER NOT NULL DEFAULT 0,
+    updated REAL,
+    PRIMARY KEY (media_id, number));
+"""
+HASH_BLOCK_SIZE = 1024 * 1024
+# MPEG audio layer III bitrates (kbit/s) by bitrate index for MPEG 1 and for
+# MPEG 2 and 2.5, and sample rates by version bits of the frame header
+MP3_BITRATES = {
+        1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000),
+        0: (11025, 12000, 8000)}
+HTTP_DEFAULTS = {
+        'timeout': 60,
+        'connect_timeout': 15,
+        'retries': 5,
+        'backoff': 1.0,
+        'backoff_max': 60}
+HTTP_POOL_CONNECTIONS = 10
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+LICENSE_REJECTED_STATUS_CODES = (401, 403)
+LICENSE_STORE_DIR = 'licenses'
+EXPIRATION_DATE_FORMATS = ('%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S',
+        '%m/%d/%Y')
+METADATA_FIELDS = ('odm', 'media_id', 'content_type', 'library',
+        'expiration_date', 'num_parts', 'downloaded_parts', 'title', 'author',
+        'publisher', 'subjects', 'language', 'description')
+# HTML in descriptions and what it becomes in plain text. A paragraph
+# opening the description is dropped rather than turned into a newline.
+DESCRIPTION_REPLACEMENTS = {'<br>': '\n', '<p>': '\n', '</p>': '',
+        '<ul>': '', '</ul>': '', '<li>': '\n* ', '</li>': ''}
+DESCRIPTION_TAGS = re.compile('|'.join(map(re.escape,
+        DESCRIPTION_REPLACEMENTS)), re.IGNORECASE)
+METRICS_PREFIX = 'overdrive_dl_'
+BANDWIDTH_BURST_SECONDS = 1.0
+BANDWIDTH_RECHECK_SECONDS = 10
+# free space to leave on the download filesystem
+DISK_RESERVE = '100M'
+# order of the books of a batch: 'smallest' first, soonest 'expiry' first
+# or as 'given'
+BATCH_ORDERS = ('smallest', 'expiry', 'given')
+BATCH_ORDER = 'expiry'
+# what to do with books that cannot be downloaded before their loan expires
+EXPIRY_ACTIONS = ('warn', 'skip')
+EXPIRY_ACTION = 'warn'
+QUEUE_FILENAME = 'queue.json'
+# failed downloads after which a book is dropped from the queue
+QUEUE_MAX_ATTEMPTS = 3
+# weight of each batch in the average download throughput, and the least a
+# batch has to download to be counted
+THROUGHPUT_WEIGHT = 0.3
+THROUGHPUT_MIN_BYTES = 1024 * 1024
+WATCH_INTERVAL = 60
+WATCH_SETTLE_SECONDS = 5
+DAEMON_UPLOAD_DIR = 'uploads'
+DAEMON_MAX_BODY_SIZE = 16 * 1024 * 1024
+# finished jobs kept for status requests
+DAEMON_KEEP_JOBS = 1000
+CACHE_DIR = '~/.cache/overdrive-dl'
+ODM_CACHE_DIR = 'odm'
+ODM_CACHE_VERSION = 1
+
+_session = None
+_session_lock = threading.Lock()
+# parsed ODM files by (path, mtime, size)
+_books = {}
+_books_lock = threading.Lock()
+_index = None
+_index_lock = threading.Lock()
+# books of batches still to be downloaded, loaded on first use
+_queue_state = None
+_queue_state_lock = threading.Lock()
+# licenses by media id, and locks so each is acquired only once at a time
+_licenses = {}
+_license_locks = {}
+_licenses_lock = threading.Lock()
+_client_id = None
+# totals per stage of the timings recorded by _record_metric
+_metrics = OrderedDict()
+_metrics_lock = threading.Lock()
+# cProfile profilers of the threads that ran profiled code, when profiling
+_profiling = False
+_profilers = []
+_profilers_lock = threading.Lock()
+_profile_local = threading.local()
+# bandwidth limit shared by all downloads
+_bandwidth_bucket = None
+_bandwidth_bucket_lock = threading.Lock()
+# progress lines currently drawn on the terminal
+_progress_displays = set()
+# Streaming starts with chunk_size byte reads, adapting between CHUNK_MIN_SIZE
+# and max_chunk_size so that each read takes about CHUNK_TARGET_SECONDS
+CHUNK_DEFAULTS = {
+        'chunk_size': 64 * 1024,
+        'max_chunk_size': 1024 * 1024}
+CHUNK_MIN_SIZE = 8 * 1024
+# Parts with at least twice segment_min_size bytes left to download are
+# split into up to this many segments downloaded at the same time
+SEGMENT_DEFAULTS = {
+        'segments': 4,
+        'segment_min_size': 32 * 1024 * 1024}
+CHUNK_TARGET_SECONDS = 0.05
+PROGRESS_REFRESH_SECONDS = 0.2
 
 
 def print_metadata(odm_filename):
-    _verify_odm_file(odm_filename)
+    book = _load_book(odm_filename)
     author, title, content_type, publisher, \
             subjects, language, description, \
-            expiration_date, library, num_parts = _extract_metadata(odm_filename)
+            expiration_date, library, num_parts = _extract_metadata(book)
     logging.info('Printing Metadata from ODM file {}'.format(odm_filename))
+    status = _get_index().book_status(book.media_id)
+    downloaded = '{}/{} parts'.format(status['complete_parts'], num_parts) \
+            if status else 'no'
     print('Content Type: {}\nLibrary: {}\nExpiration Date: {}\n'
-            'Number of Parts: {}\nTitle: {}\nAuthor: {}\nPublisher: {}\n'
-            'Subjects: {}\nLanguage: {}\nDescription: '.format(
-                content_type, library, expiration_date, num_parts, title,
-                author, publisher, subjects, language))
+            'Number of Parts: {}\nDownloaded: {}\nTitle: {}\nAuthor: {}\n'
+            'Publisher: {}\nSubjects: {}\nLanguage: {}\nDescription: '.format(
+                content_type, library, expiration_date, num_parts, downloaded,
+                title, author, publisher, subjects, language))
+    # Optional support for printing formatted descriptions
+    try:
+        from prompt_toolkit import print_formatted_text, HTML
+    except ImportError:
+        print(description)
+        return
     try:
         print_formatted_text(HTML(description))
     except ExpatError:
         print(description)
 
+def print_metadata_records(odm_filenames, output_format):
+    """Prints the metadata of each ODM file as a line of JSON or a CSV
+    row, as soon as it is read. Files that cannot be read are reported and
+    skipped. Returns whether all of them could be read."""
+    if output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, METADATA_FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda record: print(json.dumps(record))
+    index = _get_index()
+    failures = 0
+    for odm_filename in odm_filenames:
+        try:
+            book = _load_book(odm_filename)
+            author, title, content_type, publisher, \
+                    subjects, language, description, expiration_date, \
+                    library, num_parts = _extract_metadata(book)
+        except (Exception, SystemExit) as e:
+            # _die already reported the cause of a SystemExit
+            if not isinstance(e, SystemExit):
+                logging.error('Failed to read {}: {}'.format(odm_filename, e))
+            failures += 1
+            continue
+        status = index.book_status(book.media_id)
+        write({'odm': odm_filename,
+                'media_id': book.media_id,
+                'content_type': content_type,
+                'library': library,
+                'expiration_date': expiration_date,
+                'num_parts': num_parts,
+                'downloaded_parts': status['complete_parts'] if status
+                        else None,
+                'title': title,
+                'author': author,
+                'publisher': publisher,
+                'subjects': subjects,
+                'language': language,
+                'description': description})
+    return not failures
+
 def download_audiobook(
         odm_filename,
         update_tags=False,
         update_owner=False,
-        force_download=False):
-    _verify_odm_file(odm_filename)
-    license, client_id = _get_license_and_client_id(odm_filename)
+        force_download=False,
+        jobs=1,
+        pool=None,
+        progress=None,
+        cancel=None,
+        merge=False):
+    start_time = time.monotonic()
+    book = _load_book(odm_filename)
+    license, client_id = _get_license_and_client_id(book)
     author, title, cover_url, base_url, parts = \
-            _extract_author_title_urls_parts(odm_filename)
+            _extract_author_title_urls_parts(book)
     num_parts = len(parts)
 
     download_dir = _construct_download_dir_path(author, title)
     logging.debug('Will save files to {}'.format(download_dir))
+    needed = _bytes_to_download(book, force_download)
+    if merge:
+        needed += _bytes_to_merge(book, needed, force_download)
+    _check_free_space(needed, download_dir)
     if not isdir(download_dir):
         logging.debug('Creating {}'.format(download_dir))
         os.makedirs(download_dir, exist_ok=True)
@@ -98,171 +296,1860 @@ def download_audiobook(
             _download_cover_image(cover_url, cover_path)
     logging.debug('Using ClientID: {}'.format(client_id))
 
-    headers = {
-        'License': license,
-        'ClientID': client_id,
-        'User-Agent': USER_AGENT
-        }
+    headers = _license_headers(license, client_id)
+
+    def renew_headers(rejected_headers):
+        return _license_headers(
+                *_renew_license(book, rejected_headers['License']))
+
     logging.info('Downloading {} parts:'.format(num_parts))
+    manifest = _Manifest(download_dir)
+    manifest.odm = odm_filename
+    manifest.media_id = book.media_id
+    index = _get_index()
+    index.record_book(book, download_dir)
+    to_download = []
+    present = []
     for part in parts:
-        logging.info('Downloading {} of {}'.format(
-            part.get('name'),
-            num_parts))
         logging.debug('Filename: {}\nFilesize: {}\nDuration: {}'.format(
-                part.get('filename'),
-                part.get('filesize'),
-                part.get('duration')))
-        dl_url = base_url + '/' + part.get('filename')
+                part.filename,
+                part.filesize,
+                part.duration))
         filepath = download_dir \
                 + sep \
-                + DOWNLOAD_FILENAME_FORMAT.format(
-                        number=int(part.get('number')))
-        filesize = int(part.get('filesize'))
-        if _file_exists(filepath, filesize):
-            logging.info('{} already exists'.format(part.get('name')) \
+                + DOWNLOAD_FILENAME_FORMAT.format(number=part.number)
+        filesize = part.filesize
+        if str(part.number) in manifest.parts:
+            is_complete = manifest.is_complete(part.number, filepath)
+        else:
+            # Parts downloaded before manifests were kept only have a size
+            is_complete = _file_exists(filepath, filesize)
+        if is_complete:
+            logging.info('{} already exists'.format(part.name) \
                     + ' with expected size' \
                     + ' {:.2f}MB: {}'.format(filesize/(1024.0*1024.0), filepath))
             if not force_download:
-                logging.info('Skipping downloading {}'.format(
-                    part.get('name')))
+                logging.info('Skipping downloading {}'.format(part.name))
+                present.append((part.number, filepath))
+                index.record_part(book.media_id, part.number,
+                        manifest.parts.get(str(part.number))
+                        or {'filename': basename(filepath), 'size': filesize})
                 continue
             else:
                 logging.info('Overwriting file {}'.format(filepath))
+        to_download.append((part, filepath, filesize))
 
-        r = requests.get(dl_url, headers=headers, stream=True)
-        total_bytes = int(r.headers.get('content-length'))
-        expected_iterations = int(math.ceil(total_bytes / CHUNK_SIZE))
-        downloaded_bytes = 0
-        with open(filepath, 'wb') as fd:
-            start_time = time.time()
-            for it, chunk in enumerate(r.iter_content(chunk_size=CHUNK_SIZE)):
-                fd.write(chunk)
-                now = time.time()
-                bytes_downloaded = len(chunk)
-                elapsed = now - start_time
-                downloaded_bytes += bytes_downloaded
-                percent = downloaded_bytes / total_bytes * 100
-                avg_speed = downloaded_bytes / elapsed
-                est_total = total_bytes / avg_speed
-                est_eta = (total_bytes - downloaded_bytes) / avg_speed
-                progress_str = '[{:.2f}%] {} / {}  {:.1f}s/{:.1f}s' \
-                        '  {:.2f}B/s    {:.1f}s eta'.format(
-                                percent,
-                                downloaded_bytes,
-                                total_bytes,
-                                elapsed,
-                                est_total,
-                                avg_speed,
-                                est_eta)
-                if downloaded_bytes != CHUNK_SIZE:
-                    # not first iteration
-                    progress_str = '\033[G' + progress_str 
-                if it + 1 == expected_iterations:
-                    # last iteration
-                    progress_str += '\n'
-                sys.stdout.write(progress_str)
-                sys.stdout.flush()
-                # TODO look into using tqdm as progress bar
-
-    # Update ID3 tags
+    if cancel is None:
+        cancel = threading.Event()
+    own_pool = pool is None
+    if own_pool:
+        pool = _DownloadPool(jobs)
+    own_progress = progress is None
+    if own_progress:
+        progress = _Progress()
+    merger = None
+    if merge:
+        merger = _Merger(book, download_dir, title)
+        if _file_exists(merger.filepath) and not to_download \
+                and not force_download:
+            logging.info('Merged file {} already exists'.format(
+                merger.filepath))
+            merger = None
+    tagger = None
     if update_tags and 'tags' in config:
-        _update_tags(config['tags'], download_dir, num_parts)
+        # Parts are tagged as soon as they are available, while the rest
+        # are still downloading. Tagging rewrites a part, so it is only
+        # merged once tagged.
+        tagger = _Tagger(config['tags'], book, manifest, pool.jobs,
+                on_tagged=merger.submit if merger else None)
+    part_ready = tagger.submit if tagger \
+            else merger.submit if merger else None
+    if part_ready:
+        for number, filepath in present:
+            part_ready(number, filepath)
+    # Parts of this book share its own bandwidth limit as well as the one
+    # shared by all downloads
+    buckets = (_get_bandwidth_bucket(), _TokenBucket('book_rate'))
+    progress.add(sum(filesize for _, _, filesize in to_download),
+            len(to_download))
+    futures = {pool.submit(
+                base_url,
+                _download_part,
+                base_url + '/' + part.filename,
+                filepath,
+                filesize,
+                headers,
+                part.number,
+                part.name,
+                num_parts,
+                progress,
+                resume=not force_download,
+                cancel=cancel,
+                renew_headers=renew_headers,
+                buckets=buckets,
+                pool=pool): part.number
+            for part, filepath, filesize in to_download}
+    downloaded_bytes = 0
+    try:
+        for future in as_completed(futures):
+            part_bytes, entry = future.result()
+            downloaded_bytes += part_bytes
+            # Record each part as it completes so an interrupted run keeps
+            # the records of the parts it did finish
+            manifest.parts[str(futures[future])] = entry
+            manifest.save()
+            index.record_part(book.media_id, futures[future], entry)
+            if part_ready:
+                part_ready(futures[future],
+                        join(download_dir, entry['filename']))
+        if tagger:
+            tagger.wait()
+            index.set_state(book.media_id, 'tags_updated')
+        if merger:
+            merger.wait()
+    except BaseException:
+        # Stop the parts that are still downloading rather than waiting
+        # for them to finish
+        cancel.set()
+        for future in futures:
+            future.cancel()
+        if tagger:
+            tagger.shutdown()
+        if merger:
+            merger.shutdown()
+        raise
+    finally:
+        if own_progress:
+            progress.close()
+        if own_pool:
+            pool.shutdown(wait=not cancel.is_set())
 
     # Update Owner info
     if update_owner and 'owner' in config:
-        _update_owner(config['owner'].get('user'),
-                config['owner'].get('group'),
-                download_dir,
-                num_parts,
-                title)
+        with _timed('chown', directory=download_dir):
+            _update_owner(config['owner'].get('user'),
+                    config['owner'].get('group'),
+                    download_dir,
+                    num_parts,
+                    title)
+        index.set_state(book.media_id, 'owner_updated')
+    _record_metric('book', time.monotonic() - start_time,
+            media_id=book.media_id, title=book.title,
+            parts=len(to_download), bytes=downloaded_bytes)
+    return downloaded_bytes
+
+def download_audiobooks(odm_filenames, pool, resume_queue=False,
+        **download_options):
+    report = _BatchReport()
+    queue = _get_queue_state()
+    if resume_queue:
+        # Books left over from an interrupted batch join this one
+        odm_filenames = queue.extend(odm_filenames)
+    odm_filenames, skipped = _plan_batch(odm_filenames,
+            download_options.get('force_download', False), queue,
+            download_options.get('merge', False))
+    queue.save()
+    for odm_filename, reason in skipped:
+        logging.warning('Skipping {}: {}'.format(odm_filename, reason))
+        report.add_skipped(odm_filename, reason)
+    progress = _Progress()
+    cancel_events = []
+    # Acquire the licenses of the whole batch up front, alongside the
+    # downloads, so books do not wait for their license one after another
+    license_executor = ThreadPoolExecutor(max_workers=pool.jobs)
+    for odm_filename in odm_filenames:
+        license_executor.submit(_prefetch_license, odm_filename)
+    license_executor.shutdown(wait=False)
+    # Books share the part download pool, which enforces the global and
+    # per-host limits, so running them side by side only overlaps the
+    # license and cover requests with part downloads
+    with ThreadPoolExecutor(max_workers=pool.jobs) as executor:
+        futures = {}
+        for odm_filename in odm_filenames:
+            # Each book gets its own cancel event so that a failing book
+            # only stops its own parts
+            cancel = threading.Event()
+            cancel_events.append(cancel)
+            futures[executor.submit(
+                    _profiled,
+                    download_audiobook,
+                    odm_filename,
+                    pool=pool,
+                    progress=progress,
+                    cancel=cancel,
+                    **download_options)] = odm_filename
+        try:
+            for future in as_completed(futures):
+                try:
+                    report.add_book(future.result())
+                except (Exception, SystemExit) as e:
+                    # _die already reported the cause of a SystemExit
+                    if not isinstance(e, SystemExit):
+                        logging.error('Failed to download {}: {}'.format(
+                            futures[future], e))
+                    report.add_failure(futures[future])
+                    queue.record_failure(futures[future])
+                    queue.save()
+                else:
+                    queue.remove(futures[future])
+                    queue.save()
+        except BaseException:
+            for cancel in cancel_events:
+                cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            progress.close()
+            if report.downloaded_bytes >= THROUGHPUT_MIN_BYTES:
+                queue.record_throughput(report.downloaded_bytes
+                        / max(time.time() - report.start_time, 1e-6))
+                queue.save()
+    return report
+
+def watch_directory(watch_dir, pool, interval, **download_options):
+    logging.info('Watching {} for ODM files'.format(watch_dir))
+    processed = {}
+    while True:
+        now = time.time()
+        new_odm_filenames = []
+        for odm_filename in _expand_odm_filenames([watch_dir]):
+            mtime = getmtime(odm_filename)
+            # Leave files that are still being written for the next scan
+            if processed.get(odm_filename) != mtime \
+                    and now - mtime >= WATCH_SETTLE_SECONDS:
+                new_odm_filenames.append((odm_filename, mtime))
+        if new_odm_filenames:
+            report = download_audiobooks(
+                    [odm_filename for odm_filename, _ in new_odm_filenames],
+                    pool,
+                    **download_options)
+            report.print_summary()
+            for odm_filename, mtime in new_odm_filenames:
+                # Skipped books are tried again once there is space
+                if odm_filename not in report.failures \
+                        and odm_filename not in report.skipped:
+                    processed[odm_filename] = mtime
+        time.sleep(interval)
+
+def serve_daemon(address, pool, **download_options):
+    """Runs download jobs submitted over a JSON API on a Unix socket (a
+    path) or TCP (host:port) until interrupted."""
+    import asyncio
+    daemon = _Daemon(pool, config.get('daemon_jobs', 1), download_options)
+    try:
+        asyncio.run(daemon.serve(address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+
+class _Job(object):
+
+    def __init__(self, odm_filename, priority, options, upload=False):
+        self.id = uuid.uuid4().hex
+        self.odm_filename = odm_filename
+        # whether the ODM file was uploaded, to be removed with the job
+        self.upload = upload
+        self.priority = priority
+        self.options = options
+        self.state = 'queued'
+        # what to do once a running job has stopped: 'pause', 'cancel' or
+        # 'requeue' (resumed before its pause took effect)
+        self.stop = None
+        self.error = None
+        self.book = None
+        self.downloaded_bytes = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel = None
+        self.progress = _Progress(stream=None)
+
+    def to_dict(self):
+        d = {'id': self.id,
+                'odm': self.odm_filename,
+                'priority': self.priority,
+                'state': self.state,
+                'error': self.error,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'downloaded_bytes': self.downloaded_bytes,
+                'progress': self.progress.status()}
+        if self.book:
+            d.update(media_id=self.book.media_id, title=self.book.title,
+                    author=self.book.author)
+        return d
+
+class _Daemon(object):
+    """Queues download jobs by priority (highest first, then by loan
+    expiration and in the order they came in) and runs up to jobs books at
+    a time on the shared part download pool, so connections, licenses and
+    parsed ODM files stay warm between books.
+
+    POST /jobs takes either JSON ({"odm": path, "priority": n, "tags",
+    "owner", "force" and "merge" flags}) or an uploaded ODM file with the
+    same settings in the query string, kept until its job is forgotten.
+    GET /jobs and GET /jobs/ID report the state and progress of jobs,
+    POST /jobs/ID/pause, /resume and /cancel (or DELETE /jobs/ID) control
+    them. A paused job stops its downloads and picks up from the partial
+    files when it is resumed."""
+
+    def __init__(self, pool, jobs, download_options):
+        self.pool = pool
+        self.jobs = max(1, jobs)
+        self.download_options = download_options
+        self._jobs = OrderedDict()
+        # heap of (-priority, loan expiration, sequence number, job)
+        self._queue = []
+        self._sequence = 0
+        self._running = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self._loop = None
+
+    async def serve(self, address):
+        import asyncio
+        self._loop = asyncio.get_running_loop()
+        host, _, port = address.rpartition(':')
+        if host and port.isdigit():
+            server = await asyncio.start_server(self._handle, host, int(port))
+        else:
+            if os.path.exists(address):
+                # Left behind by a daemon that did not shut down cleanly
+                os.remove(address)
+            server = await asyncio.start_unix_server(self._handle, address)
+        logging.info('Accepting jobs on {}'.format(address))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if not port.isdigit() and os.path.exists(address):
+                os.remove(address)
+
+    def shutdown(self):
+        for job in self._jobs.values():
+            if job.cancel:
+                job.cancel.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            method, target, _ = request_line.split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length') or 0)
+            if length > DAEMON_MAX_BODY_SIZE:
+                status, result = 413, {'error': 'Request body too large'}
+            else:
+                body = await reader.readexactly(length) if length else b''
+                status, result = await self._route(
+                        method, urlparse(target), headers, body)
+        except (ValueError, TypeError, asyncio.IncompleteReadError) as e:
+            status, result = 400, {'error': 'Bad request: {}'.format(e)}
+        except Exception as e:
+            logging.exception('Failed to handle request')
+            status, result = 500, {'error': 'Internal error: {}'.format(e)}
+        data = json.dumps(result).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: close\r\n\r\n'.format(
+                    status, HTTPStatus(status).phrase, len(data)).encode(
+                        'latin-1') + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method, url, headers, body):
+        path = url.path.strip('/').split('/')
+        if path[0] != 'jobs' or len(path) > 3:
+            return 404, {'error': 'Not found'}
+        if len(path) == 1:
+            if method == 'GET':
+                return 200, {'jobs': [job.to_dict()
+                    for job in self._jobs.values()]}
+            if method == 'POST':
+                return await self._submit(url, headers, body)
+            return 405, {'error': 'Method not allowed'}
+        job = self._jobs.get(path[1])
+        if job is None:
+            return 404, {'error': 'No job {}'.format(path[1])}
+        action = path[2] if len(path) == 3 else None
+        if action is None and method == 'GET':
+            return 200, job.to_dict()
+        if action is None and method == 'DELETE':
+            action = 'cancel'
+        elif method != 'POST' or action not in ('pause', 'resume', 'cancel'):
+            return 405, {'error': 'Method not allowed'}
+        if not getattr(self, '_' + action)(job):
+            return 409, {'error': 'Cannot {} a job that is {}'.format(
+                action, job.state)}
+        return 200, job.to_dict()
+
+    async def _submit(self, url, headers, body):
+        upload = not headers.get('content-type', '').startswith(
+                'application/json')
+        if not upload:
+            request = json.loads(body.decode('utf-8') or '{}')
+            if not isinstance(request, dict) or not request.get('odm') \
+                    or not isinstance(request['odm'], str):
+                raise ValueError('expected a JSON object with an "odm" path')
+        else:
+            request = dict(parse_qsl(url.query))
+        try:
+            priority = int(request.get('priority', 0))
+        except (TypeError, ValueError):
+            raise ValueError('"priority" must be an integer')
+        if not upload:
+            odm_filename = abspath(expanduser(request['odm']))
+        else:
+            # The body is the ODM file itself
+            upload_dir = join(_cache_dir(), DAEMON_UPLOAD_DIR)
+            os.makedirs(upload_dir, exist_ok=True)
+            odm_filename = join(upload_dir, uuid.uuid4().hex + '.odm')
+            try:
+                with open(odm_filename, 'wb') as f:
+                    f.write(body)
+            except OSError:
+                _remove_file(odm_filename)
+                raise
+        options = dict(self.download_options)
+        for key, option in (('tags', 'update_tags'),
+                ('owner', 'update_owner'),
+                ('force', 'force_download'),
+                ('merge', 'merge')):
+            if key in request:
+                options[option] = str(request[key]).lower() \
+                        in ('1', 'true', 'yes')
+        job = _Job(odm_filename, priority, options, upload)
+        try:
+            job.book = await self._loop.run_in_executor(
+                    None, _load_book, odm_filename)
+        except (Exception, SystemExit):
+            # _die has already logged why
+            if upload:
+                _remove_file(odm_filename)
+            return 400, {'error': 'Not a readable ODM file: {}'.format(
+                request.get('odm', 'upload'))}
+        self._jobs[job.id] = job
+        self._prune()
+        self._enqueue(job)
+        logging.info('Queued job {} for {}'.format(job.id, odm_filename))
+        return 201, job.to_dict()
+
+    def _pause(self, job):
+        if job.state == 'queued':
+            job.state = 'paused'
+        elif job.state == 'running':
+            job.stop = 'pause'
+            job.cancel.set()
+        else:
+            return False
+        return True
+
+    def _resume(self, job):
+        if job.state == 'paused':
+            self._enqueue(job)
+        elif job.state == 'running' and job.stop == 'pause':
+            job.stop = 'requeue'
+        else:
+            return False
+        return True
+
+    def _cancel(self, job):
+        if job.state in ('queued', 'paused'):
+            job.state = 'cancelled'
+            job.finished = time.time()
+        elif job.state == 'running':
+            job.stop = 'cancel'
+            job.cancel.set()
+        else:
+            return False
+        return True
+
+    def _enqueue(self, job):
+        job.state = 'queued'
+        self._sequence += 1
+        heapq.heappush(self._queue, (-job.priority,
+            _book_expiration(job.book), self._sequence, job))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._queue and self._running < self.jobs:
+            job = heapq.heappop(self._queue)[-1]
+            # Jobs paused or cancelled while queued are left in the heap
+            if job.state != 'queued':
+                continue
+            self._running += 1
+            job.state = 'running'
+            job.stop = None
+            job.started = time.time()
+            # A resumed job starts over, skipping the parts it finished
+            job.cancel = threading.Event()
+            job.progress = _Progress(stream=None)
+            self._loop.create_task(self._run(job))
+
+    async def _run(self, job):
+        try:
+            job.downloaded_bytes += await self._loop.run_in_executor(
+                    self._executor,
+                    functools.partial(_profiled,
+                        download_audiobook,
+                        job.odm_filename,
+                        pool=self.pool,
+                        progress=job.progress,
+                        cancel=job.cancel,
+                        **job.options))
+        except (Exception, SystemExit) as e:
+            if job.stop == 'requeue':
+                self._enqueue(job)
+            elif job.stop in ('pause', 'cancel'):
+                job.state = 'paused' if job.stop == 'pause' else 'cancelled'
+            else:
+                job.state = 'failed'
+                job.error = str(e) if not isinstance(e, SystemExit) \
+                        else 'Download failed'
+                logging.error('Job {} failed: {}'.format(job.id, job.error))
+        else:
+            job.state = 'done'
+        finally:
+            if job.state != 'queued':
+                job.finished = time.time()
+            self._running -= 1
+            self._dispatch()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items()
+                if job.state in ('done', 'failed', 'cancelled')]
+        for job_id in finished[:max(0, len(self._jobs) - DAEMON_KEEP_JOBS)]:
+            job = self._jobs.pop(job_id)
+            if job.upload:
+                _remove_file(job.odm_filename)
+
+def _plan_batch(odm_filenames, force_download=False, queue=None,
+        merge=False):
+    """Orders a batch according to batch_order and leaves out the books
+    that would not fit in the free space of the download filesystem, less
+    disk_reserve, counting their merged files when merge is set. Books
+    that will not be downloaded before their loan expires at the throughput
+    measured so far are warned about, or left out if expiry_action is
+    'skip'. Returns the ODM files to download and (ODM file, reason) for
+    those left out."""
+    batch_order = config.get('batch_order', BATCH_ORDER)
+    if batch_order not in BATCH_ORDERS:
+        _die('Invalid batch_order: {} (expected one of {})'.format(
+            batch_order, ', '.join(BATCH_ORDERS)))
+    expiry_action = config.get('expiry_action', EXPIRY_ACTION)
+    if expiry_action not in EXPIRY_ACTIONS:
+        _die('Invalid expiry_action: {} (expected one of {})'.format(
+            expiry_action, ', '.join(EXPIRY_ACTIONS)))
+    index = _get_index()
+    planned = []
+    for odm_filename in odm_filenames:
+        try:
+            book = _load_book(odm_filename)
+        except (Exception, SystemExit):
+            # Left for download_audiobook to report. It will not be
+            # readable next time either.
+            if queue is not None:
+                queue.remove(odm_filename)
+            planned.append((odm_filename, None, 0, 0))
+            continue
+        if queue is not None:
+            queue.add(odm_filename, book)
+        status = None if force_download else index.book_status(book.media_id)
+        if status and status['complete_parts'] == len(book.parts):
+            # Books the index has as complete need no stat of every part.
+            # download_audiobook still checks the parts it skips.
+            needed = 0
+        else:
+            needed = _bytes_to_download(book, force_download)
+        # The merged file takes space but does not have to be downloaded
+        space = needed
+        if merge:
+            space += _bytes_to_merge(book, needed, force_download)
+        planned.append((odm_filename, book, needed, space))
+    if batch_order == 'smallest':
+        planned.sort(key=lambda plan: plan[2])
+    elif batch_order == 'expiry':
+        # Books whose loans have already expired can only be wasted work
+        # for the others, so they go last
+        now = time.time()
+        planned.sort(key=lambda plan: (_book_expiration(plan[1]) <= now,
+            _book_expiration(plan[1]), plan[2]))
+    free = _free_space(config['download_dir'])
+    if free is not None:
+        free -= _parse_size(config.get('disk_reserve', DISK_RESERVE),
+                'disk_reserve')
+    throughput = queue.throughput if queue is not None else None
+    now = time.time()
+    # bytes to download before each book is done
+    queued_bytes = 0
+    selected = []
+    skipped = []
+    for odm_filename, book, needed, space in planned:
+        if free is not None and space and space > free:
+            skipped.append((odm_filename,
+                'needs {:.2f}MB, {:.2f}MB free'.format(
+                    space / (1024.0*1024.0),
+                    max(free, 0) / (1024.0*1024.0))))
+            continue
+        expiration = _book_expiration(book)
+        late = None
+        if expiration <= now:
+            late = 'loan expired on {}'.format(book.expiration_date)
+        elif needed and throughput:
+            finish = now + (queued_bytes + needed) / throughput
+            if finish > expiration:
+                late = 'loan expires on {}, about {:.0f}s before it would' \
+                        ' be downloaded at {:.2f}MB/s'.format(
+                            book.expiration_date,
+                            finish - expiration,
+                            throughput / (1024.0*1024.0))
+        if late and expiry_action == 'skip':
+            skipped.append((odm_filename, late))
+            continue
+        if late:
+            logging.warning('{}: {}'.format(odm_filename, late))
+        if free is not None:
+            free -= space
+        queued_bytes += needed
+        selected.append(odm_filename)
+    return selected, skipped
+
+class _QueueState(object):
+    """Books of batches that have not been downloaded yet, with their loan
+    expiration, and the average download throughput of past batches. Kept
+    in a file so that an interrupted batch carries on with its remaining
+    books, in the same order, the next time one runs."""
+
+    def __init__(self, path):
+        self.path = path
+        # ODM file -> {'media_id', 'title', 'expires', 'queued',
+        # 'attempts'}
+        self.books = OrderedDict()
+        # bytes per second, None until a batch has been measured
+        self.throughput = None
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as fd:
+                data = json.load(fd)
+            self.books.update(data.get('books', {}))
+            self.throughput = data.get('throughput')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable queue state {}: {}'.format(
+                self.path, e))
+
+    def extend(self, odm_filenames):
+        """The given ODM files followed by the queued books not among them
+        whose ODM files are still there and loans have not expired."""
+        odm_filenames = list(odm_filenames)
+        given = set(odm_filenames)
+        now = time.time()
+        with self._lock:
+            for odm_filename, entry in list(self.books.items()):
+                if odm_filename in given:
+                    continue
+                if not isfile(odm_filename) or (entry.get('expires')
+                        and entry['expires'] <= now):
+                    logging.info('Dropping {} from the queue'.format(
+                        odm_filename))
+                    del self.books[odm_filename]
+                    continue
+                logging.info('Resuming queued book {}'.format(odm_filename))
+                odm_filenames.append(odm_filename)
+        return odm_filenames
+
+    def add(self, odm_filename, book):
+        with self._lock:
+            entry = self.books.setdefault(odm_filename,
+                    {'queued': time.time()})
+            entry.update(media_id=book.media_id, title=book.title,
+                    expires=_parse_expiration(book.expiration_date))
+
+    def remove(self, odm_filename):
+        with self._lock:
+            self.books.pop(odm_filename, None)
+
+    def record_failure(self, odm_filename):
+        """Counts a failed download of a book, dropping it once it has
+        failed queue_max_attempts times or its loan has expired."""
+        max_attempts = config.get('queue_max_attempts', QUEUE_MAX_ATTEMPTS)
+        with self._lock:
+            entry = self.books.get(odm_filename)
+            if entry is None:
+                return
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            if entry['attempts'] >= max_attempts or (entry.get('expires')
+                    and entry['expires'] <= time.time()):
+                logging.info('Dropping {} from the queue after {} failed'
+                        ' attempts'.format(odm_filename, entry['attempts']))
+                del self.books[odm_filename]
+
+    def record_throughput(self, bytes_per_second):
+        with self._lock:
+            if self.throughput is None:
+                self.throughput = bytes_per_second
+            else:
+                self.throughput += THROUGHPUT_WEIGHT \
+                        * (bytes_per_second - self.throughput)
+
+    def save(self):
+        with self._lock:
+            os.makedirs(dirname(self.path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as fd:
+                json.dump({'books': self.books,
+                    'throughput': self.throughput}, fd, indent=2)
+            os.replace(tmp_path, self.path)
+
+def _get_queue_state():
+    global _queue_state
+    with _queue_state_lock:
+        if _queue_state is None:
+            _queue_state = _QueueState(abspath(expanduser(config.get(
+                'queue_file', join(_cache_dir(), QUEUE_FILENAME)))))
+        return _queue_state
+
+def _book_expiration(book):
+    # Sort key putting books that expire soonest first and those with an
+    # unknown expiration last
+    expiration = _parse_expiration(book.expiration_date) if book else None
+    return expiration if expiration is not None else float('inf')
+
+def _bytes_to_download(book, force_download=False):
+    """Bytes the parts of a book still need on disk. Partial files are
+    preallocated, so what they take up already counts as there."""
+    author, title = book.author, book.title
+    if config['filenames_lowercase']:
+        author = author.lower()
+        title = title.lower()
+    download_dir = _construct_download_dir_path(author, title)
+    needed = 0
+    for part in book.parts:
+        needed += part.filesize
+        if force_download:
+            continue
+        filepath = join(download_dir,
+                DOWNLOAD_FILENAME_FORMAT.format(number=part.number))
+        for path in (filepath, filepath + PARTIAL_SUFFIX):
+            try:
+                needed -= min(part.filesize, os.stat(path).st_blocks * 512)
+                break
+            except OSError:
+                pass
+    return needed
+
+def _bytes_to_merge(book, needed, force_download=False):
+    """Bytes the merged file of a book needs on disk, given the bytes its
+    parts still need. It is written again, next to the old one, whenever a
+    part is downloaded."""
+    if not needed and not force_download:
+        author, title = book.author, book.title
+        if config['filenames_lowercase']:
+            author = author.lower()
+            title = title.lower()
+        if isfile(join(_construct_download_dir_path(author, title),
+                MERGED_FILENAME_FORMAT.format(title=title))):
+            return 0
+    return sum(part.filesize for part in book.parts)
+
+def _free_space(path):
+    """Bytes free for unprivileged users on the filesystem of path, or
+    None if that cannot be told."""
+    path = abspath(expanduser(path))
+    # The download directory may not have been created yet
+    while not os.path.exists(path) and dirname(path) != path:
+        path = dirname(path)
+    try:
+        st = os.statvfs(path)
+    except (AttributeError, OSError):
+        return None
+    return st.f_bavail * st.f_frsize
+
+def _check_free_space(needed, download_dir):
+    free = _free_space(download_dir)
+    if free is None:
+        return
+    reserve = _parse_size(config.get('disk_reserve', DISK_RESERVE),
+            'disk_reserve')
+    if needed and needed > free - reserve:
+        _die('Not enough space in {}: need {:.2f}MB, {:.2f}MB free'
+                ' ({:.2f}MB kept in reserve)'.format(
+                    download_dir,
+                    needed / (1024.0*1024.0),
+                    free / (1024.0*1024.0),
+                    reserve / (1024.0*1024.0)))
+
+class _BatchReport(object):
+
+    def __init__(self):
+        self.books = 0
+        self.downloaded_bytes = 0
+        self.failures = []
+        # ODM file -> why it was not downloaded
+        self.skipped = OrderedDict()
+        self.start_time = time.time()
+
+    def add_book(self, downloaded_bytes):
+        self.books += 1
+        self.downloaded_bytes += downloaded_bytes
+
+    def add_failure(self, odm_filename):
+        self.failures.append(odm_filename)
+
+    def add_skipped(self, odm_filename, reason):
+        self.skipped[odm_filename] = reason
+
+    def print_summary(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        print('Downloaded {} book{} ({:.2f}MB) in {:.1f}s ({:.2f}MB/s),'
+                ' {} failed, {} skipped'.format(
+                    self.books,
+                    '' if self.books == 1 else 's',
+                    self.downloaded_bytes / (1024.0*1024.0),
+                    elapsed,
+                    self.downloaded_bytes / (1024.0*1024.0) / elapsed,
+                    len(self.failures),
+                    len(self.skipped)))
+        for odm_filename in self.failures:
+            print('Failed: {}'.format(odm_filename))
+        for odm_filename, reason in self.skipped.items():
+            print('Skipped: {} ({})'.format(odm_filename, reason))
+
+class _DownloadPool(object):
+    """Thread pool shared by all part downloads, limiting the number of
+    transfers both globally and per host. Tasks wait in per-host queues and
+    are only handed to a worker once both a global slot and a slot for
+    their host are free, so a busy host cannot hold up the others."""
+
+    def __init__(self, jobs, per_host_jobs=None):
+        self.jobs = max(1, jobs)
+        self.per_host_jobs = max(1, min(per_host_jobs or self.jobs, self.jobs))
+        # host -> deque of (future, fn, args, kwargs) waiting for a slot
+        self._queues = OrderedDict()
+        # host -> number of running tasks
+        self._running = {}
+        self._num_running = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def submit(self, url, fn, *args, **kwargs):
+        future = Future()
+        host = urlparse(url).netloc
+        with self._lock:
+            self._queues.setdefault(host, deque()).append(
+                    (future, fn, args, kwargs))
+            self._dispatch()
+        return future
+
+    def acquire(self, url, count):
+        """Takes up to count more slots on the host of url for a task that
+        is already running, such as the other segments of a part, without
+        waiting for any. Returns how many it took."""
+        host = urlparse(url).netloc
+        with self._lock:
+            count = max(0, min(count, self.jobs - self._num_running,
+                self.per_host_jobs - self._running.get(host, 0)))
+            self._running[host] = self._running.get(host, 0) + count
+            self._num_running += count
+        return count
+
+    def release(self, url, count):
+        host = urlparse(url).netloc
+        with self._lock:
+            self._running[host] -= count
+            self._num_running -= count
+            self._dispatch()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            for queue in self._queues.values():
+                for future, _, _, _ in queue:
+                    future.cancel()
+            self._queues.clear()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _dispatch(self):
+        # Must be called with self._lock held
+        for host in list(self._queues):
+            queue = self._queues[host]
+            while queue \
+                    and self._num_running < self.jobs \
+                    and self._running.get(host, 0) < self.per_host_jobs:
+                future, fn, args, kwargs = queue.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._running[host] = self._running.get(host, 0) + 1
+                self._num_running += 1
+                self._executor.submit(self._run, host, future, fn, args, kwargs)
+            if queue:
+                # Let the other hosts go first next time
+                self._queues.move_to_end(host)
+            else:
+                del self._queues[host]
+
+    def _run(self, host, future, fn, args, kwargs):
+        try:
+            result = _profiled(fn, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                self._running[host] -= 1
+                self._num_running -= 1
+                self._dispatch()
+
+def _download_part(dl_url, filepath, filesize, headers, number, name,
+        num_parts, progress, resume=True, cancel=None, renew_headers=None,
+        buckets=(), pool=None):
+    logging.info('Downloading {} of {}'.format(name, num_parts))
+    return _PartDownload(dl_url, filepath, filesize, headers, number, name,
+            progress, resume, cancel, renew_headers, buckets, pool).run()
+
+class _PartDownload(object):
+    """Download of one part into a partial file that is renamed into place
+    only once it is complete, so an interrupted download can be resumed
+    later. Large parts are split into byte ranges fetched over several
+    connections when the server supports range requests, each range being
+    resumed on its own when its connection breaks. The extra connections
+    take free slots of the download pool, so they count against its global
+    and per-host limits."""
+
+    def __init__(self, dl_url, filepath, filesize, headers, number, name,
+            progress, resume=True, cancel=None, renew_headers=None,
+            buckets=(), pool=None):
+        self.dl_url = dl_url
+        self.filepath = filepath
+        self.filesize = filesize
+        self.headers = headers
+        self.number = number
+        self.name = name
+        self.progress = progress
+        self.cancel = cancel
+        self.renew_headers = renew_headers
+        self.buckets = buckets
+        self.pool = pool
+        self.partial = _PartialFile(filepath, filesize)
+        self.partial.load(resume)
+        self.checksum = _StreamingChecksum()
+        # Every byte fetched, including those of attempts that are
+        # interrupted and then resumed
+        self.downloaded_bytes = 0
+        self.response_headers = {}
+        # Time to first byte of the last request and the number of requests
+        # and resumes that were retried
+        self.stats = {'ttfb': None, 'retries': 0}
+        self._license_renewed = False
+        # Stops the other ranges of the part when one of them fails
+        self._failed = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        start_time = time.monotonic()
+        self.partial.open()
+        self._slots = 0
+        try:
+            missing = self.partial.missing()
+            segments = _split_segments(missing)
+            if len(segments) > 1:
+                # This part's own slot covers one connection, the others
+                # need slots that are free right now
+                self._acquire(min(len(segments),
+                    _segment_config('segments')) - 1)
+                segments = _split_segments(missing, self._slots + 1) \
+                        if self._slots else missing[:1]
+            if len(segments) > 1:
+                self._download_segments(segments)
+            elif missing:
+                self._download_range(missing[0][0], None, self.checksum)
+        finally:
+            self.partial.close()
+            self._release()
+        downloaded_size = self.partial.size()
+        if self.partial.missing() or downloaded_size != self.filesize:
+            _die('Downloaded {} bytes of {} but expected {} bytes.'
+                    ' Run again to resume the download'.format(
+                        self.partial.done_bytes(), self.name, self.filesize))
+        # Hashes the file unless it was all downloaded in one stream in this
+        # run, as when it was already complete or downloaded in segments
+        self.checksum.seek(self.partial.path, self.filesize)
+        self.partial.finish()
+        self.progress.finish(self.filepath)
+        entry = _manifest_entry(self.filepath, self.checksum.hexdigest())
+        entry['etag'] = self.response_headers.get('ETag')
+        entry['last_modified'] = self.response_headers.get('Last-Modified')
+        elapsed = time.monotonic() - start_time
+        _record_metric('part', elapsed, part=self.name, number=self.number,
+                bytes=self.downloaded_bytes, ttfb=self.stats['ttfb'],
+                throughput=self.downloaded_bytes / max(elapsed, 1e-6),
+                retries=self.stats['retries'], segments=len(segments))
+        return self.downloaded_bytes, entry
+
+    def _acquire(self, count):
+        # Takes pool slots for the connections of segments other than the
+        # first
+        if self.pool is None:
+            self._slots = count
+        else:
+            self._slots = self.pool.acquire(self.dl_url, count)
+
+    def _release(self):
+        if self._slots and self.pool is not None:
+            self.pool.release(self.dl_url, self._slots)
+        self._slots = 0
+
+    def _download_segments(self, segments):
+        self.progress.start(self.filepath, self.number, self.filesize,
+                self.partial.done_bytes())
+        # The first segment finds out whether the server supports range
+        # requests before connections are opened for the others
+        start, end = segments[0]
+        while True:
+            try:
+                r, position = self._request(start, end)
+                break
+            except _LicenseRejected as e:
+                self._renew_license(e)
+        if r.status_code != 206:
+            logging.info('Server did not honor range request for {},'
+                    ' downloading it in one piece'.format(self.name))
+            self._release()
+            self.progress.start(self.filepath, self.number, self.filesize, 0)
+            self._download_range(0, None, self.checksum, r)
+            return
+        logging.debug('Downloading {} in {} segments'.format(
+            self.name, len(segments)))
+        # This thread downloads the first segment
+        executor = ThreadPoolExecutor(max_workers=min(len(segments) - 1,
+                self._slots))
+        futures = [executor.submit(_profiled, self._download_segment,
+                    start, end)
+                for start, end in segments[1:]]
+        errors = []
+        try:
+            self._download_segment(start, end, r)
+        except BaseException as e:
+            errors.append(e)
+        executor.shutdown(wait=True, cancel_futures=True)
+        errors.extend(future.exception() for future in futures
+                if not future.cancelled() and future.exception() is not None)
+        if errors:
+            # A failed segment stops the others, so report its error rather
+            # than theirs
+            raise next((e for e in errors
+                if not isinstance(e, _DownloadCancelled)), errors[0])
+
+    def _download_segment(self, start, end, r=None):
+        try:
+            self._download_range(start, end, None, r)
+        except BaseException:
+            self._failed.set()
+            raise
+
+    def _download_range(self, start, end, checksum, r=None):
+        # Downloads bytes start to end (or to the end of the part), resuming
+        # from what was written when the connection breaks. Only a single
+        # stream of the part from start to end is hashed on the way.
+        import requests
+        attempt = 0
+        position = start
+        while True:
+            if r is None:
+                requested = self._resume_position(start, end)
+                if requested is None:
+                    return
+                try:
+                    r, position = self._request(requested, end)
+                except _LicenseRejected as e:
+                    self._renew_license(e)
+                    continue
+                if end is not None and r.status_code != 206:
+                    r.close()
+                    _die('Server stopped honoring range requests for'
+                            ' {}'.format(self.name))
+                if checksum is not None:
+                    self.progress.start(self.filepath, self.number,
+                            self.filesize, position)
+            try:
+                self._stream(r, position, checksum)
+                return
+            except (requests.exceptions.ChunkedEncodingError,
+                    requests.ConnectionError) as e:
+                # The body was read past urllib3, so the broken connection
+                # has to be closed here rather than left to the pool
+                r.close()
+                # Only errors in the middle of the stream are retried here,
+                # _http_get has already retried failures to make the request
+                if attempt >= _http_config('retries'):
+                    _die('Failed to download {}: {}'.format(self.name, e))
+                delay = _backoff_delay(attempt)
+                logging.warning('Download of {} interrupted ({}),'
+                        ' resuming in {:.1f}s'.format(self.name, e, delay))
+                time.sleep(delay)
+                attempt += 1
+                with self._lock:
+                    self.stats['retries'] += 1
+                r = None
+            except BaseException:
+                r.close()
+                raise
+
+    def _resume_position(self, start, end):
+        # The first byte from start to end that is not written yet
+        for gap_start, gap_end in self.partial.missing():
+            if gap_end > start and (end is None or gap_start < end):
+                return max(gap_start, start)
+        return None
+
+    def _request(self, start, end):
+        """Requests bytes start to end of the part, returning the response
+        and the position its body starts at."""
+        import requests
+        part_headers = dict(self.headers)
+        if end is not None and (start or end < self.filesize):
+            part_headers['Range'] = 'bytes={}-{}'.format(start, end - 1)
+        elif start:
+            logging.info('Resuming {} from byte {}'.format(self.name, start))
+            part_headers['Range'] = 'bytes={}-'.format(start)
+
+        def count_retry():
+            with self._lock:
+                self.stats['retries'] += 1
+
+        request_time = time.monotonic()
+        try:
+            r = _http_get(self.dl_url, on_retry=count_retry,
+                    headers=part_headers, stream=True)
+        except requests.RequestException as e:
+            _die('Failed to download {}: {}'.format(self.name, e))
+        self.stats['ttfb'] = time.monotonic() - request_time
+        if r.status_code in LICENSE_REJECTED_STATUS_CODES:
+            r.close()
+            raise _LicenseRejected(part_headers['License'],
+                    'status code {}'.format(r.status_code))
+        if r.status_code not in (200, 206):
+            _die('Failed to download {}. Status code: {}'.format(
+                self.name, r.status_code))
+        if 'Range' in part_headers and r.status_code != 206:
+            if end is None:
+                logging.info('Server did not honor range request for {},'
+                        ' downloading from the beginning'.format(self.name))
+            start = 0
+        return r, start
+
+    def _renew_license(self, e):
+        rejected_license, reason = e.args
+        with self._lock:
+            if self.headers['License'] == rejected_license:
+                if self._license_renewed or self.renew_headers is None:
+                    _die('Failed to download {}: {}'.format(self.name, reason))
+                logging.warning('License rejected while downloading {} ({}),'
+                        ' acquiring a new one'.format(self.name, reason))
+                self.headers = self.renew_headers(self.headers)
+                self._license_renewed = True
+
+    def _stream(self, r, position, checksum):
+        if checksum is not None:
+            checksum.seek(self.partial.path, position)
+        for chunk in _iter_adaptive_chunks(r):
+            if self._failed.is_set() \
+                    or (self.cancel is not None and self.cancel.is_set()):
+                raise _DownloadCancelled(self.name)
+            self.partial.write(chunk, position)
+            position += len(chunk)
+            if checksum is not None:
+                checksum.update(chunk)
+            with self._lock:
+                self.downloaded_bytes += len(chunk)
+                if not self.response_headers:
+                    self.response_headers = r.headers
+            self.progress.update(self.filepath, len(chunk))
+            if self.buckets:
+                _throttle(self.buckets, len(chunk), self.cancel)
+
+def _split_segments(missing, segments=None):
+    """Splits the missing byte ranges of a part into up to segments (by
+    default the segments configuration option) segments to download at the
+    same time, of at least segment_min_size bytes each."""
+    if segments is None:
+        segments = _segment_config('segments')
+    min_size = _segment_config('segment_min_size')
+    if segments < 2:
+        return missing[:1]
+    total = sum(end - start for start, end in missing)
+    count = min(segments, total // max(min_size, 1))
+    if count < 2:
+        # The gaps left by an interrupted download in segments are still
+        # fetched on their own rather than from the first to the end
+        return missing
+    size = -(-total // count)
+    split = []
+    for start, end in missing:
+        while end - start >= size + min_size:
+            split.append((start, start + size))
+            start += size
+        split.append((start, end))
+    return split
+
+def _segment_config(key):
+    return config.get(key, SEGMENT_DEFAULTS[key])
+
+def _iter_adaptive_chunks(r):
+    """Yields the body of a streamed response in chunks of adaptive size.
+    Unless the body has to be decoded, the socket is read straight into one
+    reused buffer and the chunks are views of it, only valid until the next
+    one is read."""
+    import http.client
+    import requests
+    import urllib3
+    chunk_size = _chunk_config('chunk_size')
+    max_chunk_size = max(chunk_size, _chunk_config('max_chunk_size'))
+    # The http.client response underneath urllib3's
+    fp = getattr(r.raw, '_fp', None)
+    buf = None
+    remaining = None
+    if hasattr(fp, 'readinto') \
+            and r.headers.get('Content-Encoding', 'identity') == 'identity':
+        buf = memoryview(bytearray(max_chunk_size))
+        if r.headers.get('Content-Length', '').isdigit():
+            remaining = int(r.headers['Content-Length'])
+    while True:
+        start_time = time.monotonic()
+        # Read the raw stream directly so the chunk size can change between
+        # reads, raising the same exceptions iter_content would
+        try:
+            if buf is None:
+                chunk = r.raw.read(chunk_size, decode_content=True)
+            else:
+                chunk = buf[:fp.readinto(buf[:chunk_size])]
+                if remaining is not None:
+                    if not chunk and remaining:
+                        raise requests.exceptions.ChunkedEncodingError(
+                                'Connection broken: {} more bytes'
+                                ' expected'.format(remaining))
+                    remaining -= len(chunk)
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except urllib3.exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except urllib3.exceptions.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        except http.client.IncompleteRead as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except OSError as e:
+            # Socket errors and timeouts from reading http.client directly
+            raise requests.exceptions.ConnectionError(e)
+        if not chunk:
+            if buf is not None:
+                # urllib3 did not see the body being read, so hand the
+                # connection back to the pool for reuse
+                r.raw.release_conn()
+            break
+        yield chunk
+        # Double the chunk size while full chunks arrive well within the
+        # target interval and halve it when reading one takes much longer,
+        # so a connection that slows down is not stuck on huge reads
+        elapsed = time.monotonic() - start_time
+        if len(chunk) == chunk_size \
+                and chunk_size < max_chunk_size \
+                and elapsed < CHUNK_TARGET_SECONDS / 2:
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+        elif chunk_size > CHUNK_MIN_SIZE \
+                and elapsed > CHUNK_TARGET_SECONDS * 2:
+            chunk_size = max(chunk_size // 2, CHUNK_MIN_SIZE)
+
+class _PartialFile(object):
+    """Part being downloaded, preallocated to its full size and written in
+    place at any position, so that several ranges of it can be written at
+    once. As its size no longer tells how much is downloaded, the ranges
+    written so far are recorded in a state file next to it, saved every
+    PARTIAL_CHECKPOINT_BYTES and when the download stops."""
+
+    def __init__(self, filepath, filesize):
+        self.filepath = filepath
+        self.path = filepath + PARTIAL_SUFFIX
+        self.state_path = self.path + PARTIAL_STATE_SUFFIX
+        self.filesize = filesize
+        # sorted, non-overlapping [start, end) byte ranges written
+        self.done = []
+        self._saved_bytes = 0
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def load(self, resume=True):
+        self.done = []
+        if not resume:
+            for path in (self.state_path, self.path):
+                if isfile(path):
+                    os.remove(path)
+        elif isfile(self.state_path):
+            try:
+                with open(self.state_path, 'r') as fd:
+                    ranges = json.load(fd)['done']
+                for start, end in ranges:
+                    self._add(max(0, start), min(end, self.filesize))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.info('Ignoring unreadable download state {}: {}'.format(
+                    self.state_path, e))
+                self.done = []
+            if not isfile(self.path):
+                self.done = []
+        elif isfile(self.path):
+            # Left by versions that wrote parts from start to end
+            size = getsize(self.path)
+            if size > self.filesize:
+                logging.info('Discarding partial file {} larger than expected'
+                        ' size {}'.format(self.path, self.filesize))
+            elif size:
+                self.done = [[0, size]]
+        self._saved_bytes = self.done_bytes()
+
+    def missing(self):
+        with self._lock:
+            missing = []
+            position = 0
+            for start, end in self.done:
+                if start > position:
+                    missing.append((position, start))
+                position = max(position, end)
+            if position < self.filesize:
+                missing.append((position, self.filesize))
+            return missing
+
+    def done_bytes(self):
+        return sum(end - start for start, end in self.done)
+
+    def size(self):
+        return os.fstat(self._fd).st_size if self._fd is not None \
+                else getsize(self.path)
+
+    def open(self):
+        # Record the state before preallocating, so that a full size file
+        # is never mistaken for a complete one
+        self._save()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o666)
+        if os.fstat(self._fd).st_size > self.filesize:
+            os.ftruncate(self._fd, self.filesize)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, 0, self.filesize)
+            except OSError as e:
+                logging.debug('Could not preallocate {}: {}'.format(
+                    self.path, e))
+
+    def write(self, data, position):
+        start = position
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, position)
+            view = view[written:]
+            position += written
+        with self._lock:
+            self._add(start, position)
+            if self.done_bytes() - self._saved_bytes \
+                    >= PARTIAL_CHECKPOINT_BYTES:
+                self._save()
+
+    def close(self):
+        with self._lock:
+            self._save()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def finish(self):
+        os.replace(self.path, self.filepath)
+        if isfile(self.state_path):
+            os.remove(self.state_path)
+
+    def _add(self, start, end):
+        # Must be called with self._lock held, or before the download starts
+        if start >= end:
+            return
+        merged = []
+        for range_start, range_end in self.done:
+            if range_end < start or range_start > end:
+                merged.append([range_start, range_end])
+            else:
+                start = min(start, range_start)
+                end = max(end, range_end)
+        merged.append([start, end])
+        merged.sort()
+        self.done = merged
+
+    def _save(self):
+        # Must be called with self._lock held, or before the download starts
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as fd:
+            json.dump({'size': self.filesize, 'done': self.done}, fd)
+        os.replace(tmp_path, self.state_path)
+        self._saved_bytes = self.done_bytes()
+
+class _StreamingChecksum(object):
+    """SHA-256 of a part computed from the chunks as they are written. When
+    a download resumes from a partial file that was not hashed in this run,
+    the existing bytes are hashed first."""
+
+    def __init__(self):
+        self._hasher = hashlib.sha256()
+        self.size = 0
+
+    def seek(self, partial_path, offset):
+        if offset == self.size:
+            return
+        self._hasher = hashlib.sha256()
+        self.size = 0
+        if offset:
+            with open(partial_path, 'rb') as fd:
+                while self.size < offset:
+                    data = fd.read(min(HASH_BLOCK_SIZE, offset - self.size))
+                    if not data:
+                        break
+                    self.update(data)
+
+    def update(self, chunk):
+        self._hasher.update(chunk)
+        self.size += len(chunk)
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+class _DownloadCancelled(Exception):
+    pass
+
+class _LicenseRejected(Exception):
+    pass
+
+class _TokenBucket(object):
+    """Token bucket limiting the combined rate of the downloads sharing it to
+    the configured rate in bytes per second. Downloads take the bytes they
+    have read up front and then wait until the bucket has refilled, so
+    concurrent downloads are served in turn and get an even share."""
+
+    def __init__(self, rate_key):
+        self.rate_key = rate_key
+        self._rate = 0
+        self._rate_checked = None
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, nbytes):
+        """Takes nbytes from the bucket and returns the number of seconds to
+        wait before reading more."""
+        with self._lock:
+            now = time.monotonic()
+            if self._rate_checked is None \
+                    or now - self._rate_checked >= BANDWIDTH_RECHECK_SECONDS:
+                # The rate may change with the time of day
+                self._rate = _bandwidth_rate(self.rate_key)
+                self._rate_checked = now
+            if not self._rate:
+                self._tokens = 0.0
+                self._last = now
+                return 0
+            self._tokens = min(self._tokens + (now - self._last) * self._rate,
+                    self._rate * BANDWIDTH_BURST_SECONDS)
+            self._last = now
+            self._tokens -= nbytes
+            return max(0, -self._tokens / self._rate)
+
+def _throttle(buckets, nbytes, cancel=None):
+    delay = max(bucket.take(nbytes) for bucket in buckets)
+    if delay:
+        if cancel is not None:
+            cancel.wait(delay)
+        else:
+            time.sleep(delay)
+
+def _get_bandwidth_bucket():
+    global _bandwidth_bucket
+    with _bandwidth_bucket_lock:
+        if _bandwidth_bucket is None:
+            _bandwidth_bucket = _TokenBucket('rate')
+        return _bandwidth_bucket
+
+def _bandwidth_rate(key):
+    # The first window of the schedule containing the current time overrides
+    # the rates configured for the rest of the day
+    bandwidth = config.get('bandwidth', {})
+    rate = bandwidth.get(key, 0)
+    now = datetime.now().strftime('%H:%M')
+    for window in bandwidth.get('schedule', []):
+        start, end = window.get('start', '00:00'), window.get('end', '24:00')
+        if start <= end:
+            in_window = start <= now < end
+        else:
+            # Windows like 23:00-07:00 wrap around midnight
+            in_window = now >= start or now < end
+        if in_window:
+            rate = window.get(key, rate)
+            break
+    return _parse_rate(rate)
+
+def _parse_rate(rate):
+    # Rates are bytes per second, optionally with a K, M or G suffix
+    return _parse_size(rate, 'bandwidth rate')
+
+def _parse_size(size, what='size'):
+    # Sizes are bytes, optionally with a K, M or G suffix
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', str(size), re.I)
+    if not m:
+        _die('Invalid {}: {}'.format(what, size))
+    return int(float(m.group(1)) * 1024 ** ' KMG'.index(
+        m.group(2).upper() or ' '))
+
+def _chunk_config(key):
+    return config.get(key, CHUNK_DEFAULTS[key])
+
+class _Progress(object):
+    """Combined progress line for all parts being downloaded, safe to
+    update from several download threads at once. Without a stream it only
+    keeps count, for status() to report."""
+
+    def __init__(self, stream=sys.stdout):
+        self.total_bytes = 0
+        self.num_parts = 0
+        self.done_parts = 0
+        self.downloaded_bytes = 0
+        # bytes already on disk from earlier, interrupted downloads
+        self.resumed_bytes = 0
+        # part file path -> [downloaded bytes, total bytes, resumed bytes,
+        # part number]
+        self.active = {}
+        self.stream = stream
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._rendered = False
+        self._last_render_time = 0
+
+    def add(self, total_bytes, num_parts):
+        with self._lock:
+            self.total_bytes += total_bytes
+            self.num_parts += num_parts
+
+    def start(self, key, number, part_total_bytes, resumed_bytes=0):
+        with self._lock:
+            if key in self.active:
+                # a retried part: forget what the failed attempt counted
+                done, _, resumed, _ = self.active[key]
+                self.resumed_bytes -= resumed
+                self.downloaded_bytes -= done - resumed
+            self.active[key] = [resumed_bytes, part_total_bytes,
+                    resumed_bytes, number]
+            self.resumed_bytes += resumed_bytes
+            self._render()
+
+    def update(self, key, num_bytes):
+        with self._lock:
+            self.active[key][0] += num_bytes
+            self.downloaded_bytes += num_bytes
+            # Redraw at a fixed rate rather than for every chunk
+            if time.monotonic() - self._last_render_time \
+                    >= PROGRESS_REFRESH_SECONDS:
+                self._render()
+
+    def finish(self, key):
+        with self._lock:
+            self.active.pop(key, None)
+            self.done_parts += 1
+            self._render()
+
+    def close(self):
+        with self._lock:
+            if self._rendered:
+                self._render()
+                self.stream.write('\n')
+                self.stream.flush()
+                self._rendered = False
+            _progress_displays.discard(self)
+
+    def status(self):
+        with self._lock:
+            elapsed = max(time.time() - self.start_time, 1e-6)
+            return {'bytes': self.resumed_bytes + self.downloaded_bytes,
+                    'total_bytes': self.total_bytes,
+                    'parts': self.num_parts,
+                    'done_parts': self.done_parts,
+                    'bytes_per_second': self.downloaded_bytes / elapsed}
+
+    def clear(self):
+        # Blank the progress line so that log messages start on a clean line.
+        # It is redrawn with the next update.
+        with self._lock:
+            if self._rendered:
+                self.stream.write('\033[G\033[K')
+                self.stream.flush()
+                self._rendered = False
+
+    def _render(self):
+        if self.stream is None:
+            return
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        done_bytes = self.resumed_bytes + self.downloaded_bytes
+        total_bytes = max(self.total_bytes, done_bytes, 1)
+        percent = done_bytes / total_bytes * 100
+        avg_speed = self.downloaded_bytes / elapsed
+        if avg_speed:
+            est_total = (total_bytes - self.resumed_bytes) / avg_speed
+            est_eta = (total_bytes - done_bytes) / avg_speed
+        else:
+            est_total = est_eta = 0.0
+        progress_str = '[{:.2f}%] {} / {}  {}/{} parts  {:.1f}s/{:.1f}s' \
+                '  {:.2f}B/s    {:.1f}s eta'.format(
+                        percent,
+                        done_bytes,
+                        total_bytes,
+                        self.done_parts,
+                        self.num_parts,
+                        elapsed,
+                        est_total,
+                        avg_speed,
+                        est_eta)
+        if len(self.active) > 1:
+            progress_str += '  |' + ''.join(
+                    ' #{}:{:.0f}%'.format(number, done / max(total, 1) * 100)
+                    for done, total, _, number in self.active.values())
+        # return to start of line and clear it before redrawing
+        self.stream.write('\033[G\033[K' + progress_str)
+        self.stream.flush()
+        self._rendered = True
+        self._last_render_time = time.monotonic()
+        _progress_displays.add(self)
+
+class _ProgressLogFilter(logging.Filter):
+
+    def filter(self, record):
+        for progress in list(_progress_displays):
+            progress.clear()
+        return True
 
 def _download_cover_image(cover_url, cover_path):
+    import requests
     headers = {'User-Agent': USER_AGENT_LONG}
-    r = requests.get(cover_url, headers=headers)
-    if r.status_code == 200:
-        with open(cover_path, 'wb') as fd:
-            logging.debug('Saving as {}'.format(cover_path))
-            fd.write(r.content)
-    else:
-        logging.debug('Could not download cover. Status code: {}'.format(
-            r.status_code))
-
-def _extract_metadata(odm_filename):
-    odm_root, metadata = _get_odm_root_and_metadata(odm_filename)
-    author = _get_author_from_metadata(metadata)
-    title = metadata.findtext('Title')
-    content_type = metadata.findtext('ContentType')
-    publisher = metadata.findtext('Publisher')
-    subject_elements = metadata.findall('.//Subject')
-    subjects = ', '.join([e.text for e in subject_elements])
-    language_elements = metadata.findall('.//Language')
-    language = ', '.join([e.text for e in language_elements])
-    description = metadata.findtext('Description')
+    with _timed('cover', url=cover_url) as fields:
+        try:
+            r = _http_get(cover_url, headers=headers)
+        except requests.RequestException as e:
+            logging.warning('Could not download cover: {}'.format(e))
+            return
+        if r.status_code == 200:
+            with open(cover_path, 'wb') as fd:
+                logging.debug('Saving as {}'.format(cover_path))
+                fd.write(r.content)
+            fields['bytes'] = len(r.content)
+        else:
+            logging.debug('Could not download cover. Status code: {}'.format(
+                r.status_code))
+
+def _extract_metadata(book):
+    description = book.description
     logging.debug('Pre-processed description: {}'.format(description))
-    # convert line breaks to newlines
-    description = re.sub('<br>', '\n', description, flags=re.IGNORECASE)
-    # convert first paragraph tag to nothing
-    description = re.sub('^<p>', '', description, flags=re.IGNORECASE)
-    # convert subsequent paragraph tags to newlines
-    description = re.sub('<p>', '\n', description, flags=re.IGNORECASE)
-    # swallow closing tags and list tags
-    description = re.sub(r'</p>', '', description, flags=re.IGNORECASE)
-    description = re.sub(r'<ul>', '', description, flags=re.IGNORECASE)
-    description = re.sub(r'</ul>', '', description, flags=re.IGNORECASE)
-    # convert list items to use asteriks
-    description = re.sub(r'<li>', '\n* ', description, flags=re.IGNORECASE)
-    description = re.sub(r'</li>', '', description, flags=re.IGNORECASE)
-
-    expiration_date = odm_root.findtext('.//ExpirationDate')
-    library = odm_root.findtext('.//Source/Name')
-    p = odm_root.find('.//Parts')
-    num_parts = int(p.get('count', default=0)) if p is not None else 0
-    return (author, title, content_type, publisher, subjects,
-            language, description, expiration_date, library, num_parts)
-
-def _extract_author_title_urls_parts(odm_filename):
-    odm_root, metadata = _get_odm_root_and_metadata(odm_filename)
-    author = _get_author_from_metadata(metadata)
-    title = metadata.findtext('Title')
-    cover_url = metadata.findtext('CoverUrl', '')
+    description = DESCRIPTION_TAGS.sub(_replace_description_tag, description)
+    return (book.author, book.title, book.content_type, book.publisher,
+            book.subjects, book.language, description, book.expiration_date,
+            book.library, book.num_parts)
+
+def _replace_description_tag(m):
+    tag = m.group(0).lower()
+    if m.start() == 0 and tag == '<p>':
+        return ''
+    return DESCRIPTION_REPLACEMENTS[tag]
+
+def _extract_author_title_urls_parts(book):
+    author = book.author
+    title = book.title
     logging.info('Got title "{}" and author'.format(title)
                  + ('s' if ';' in author else '')
                  + ' {} from ODM file {}'.format(
                      ', '.join(author.split(';')),
-                     basename(odm_filename)))
+                     basename(book.odm_filename)))
     
     if config['filenames_lowercase']:
         author = author.lower()
         title = title.lower()
 
-    # Find the Protocol element with the URL for downloading
-    p = odm_root.find('.//Protocol[@method="download"]')
-    base_url = p.get('baseurl', default='') if p is not None else ''
-    if not base_url:
+    if not book.base_url:
         _die('Trouble extracting URL from ODM file')
-
-    p = odm_root.find('.//Parts')
-    num_parts = int(p.get('count', default=0)) if p is not None else 0
-    # Find all the parts to download
-    parts = odm_root.findall('.//Part')
-    if len(parts) != num_parts:
+    if len(book.parts) != book.num_parts:
         _die('Bad ODM file: Expecting {} parts, but found {}'
-        'part records'.format(num_parts, len(parts)))
-    return (author, title, cover_url, base_url, parts)
+        'part records'.format(book.num_parts, len(book.parts)))
+    return (author, title, book.cover_url, book.base_url, book.parts)
 
-def _get_odm_root_and_metadata(odm_filename):
-    odm_str = ''
-    with open(odm_filename, 'r') as fd:
-        odm_str = fd.read()
+class _Book(object):
+    """What overdrive-dl needs from an ODM file, small enough to cache."""
 
-    root = ET.fromstring(odm_str)
-    m = re.search(r'<Metadata>.*</Metadata>', odm_str, flags=re.S)
-    if not m:
+    __slots__ = ('odm_filename', 'media_id', 'acquisition_url', 'author',
+            'title', 'content_type', 'publisher', 'subjects', 'language',
+            'description', 'cover_url', 'base_url', 'expiration_date',
+            'library', 'num_parts', 'parts')
+
+    def to_dict(self):
+        d = {key: getattr(self, key) for key in self.__slots__}
+        d['parts'] = [part.to_list() for part in self.parts]
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        book = cls()
+        for key in cls.__slots__:
+            setattr(book, key, d[key])
+        book.parts = [_Part(*values) for values in d['parts']]
+        return book
+
+class _Part(object):
+
+    __slots__ = ('number', 'name', 'filename', 'filesize', 'duration')
+
+    def __init__(self, number, name, filename, filesize, duration):
+        self.number = number
+        self.name = name
+        self.filename = filename
+        self.filesize = filesize
+        self.duration = duration
+
+    def to_list(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+def _load_book(odm_filename):
+    try:
+        st = os.stat(odm_filename)
+    except OSError:
+        st = None
+    if st is None or not isfile(odm_filename):
+        _verify_odm_file(odm_filename)
+    key = (odm_filename, st.st_mtime_ns, st.st_size)
+    with _books_lock:
+        book = _books.get(key)
+    if book is not None:
+        return book
+    cache_path = join(_cache_dir(), ODM_CACHE_DIR,
+            hashlib.sha1(odm_filename.encode('utf-8')).hexdigest() + '.json')
+    book = _read_book_cache(cache_path, st)
+    if book is None:
+        _verify_odm_file(odm_filename)
+        with _timed('odm_parse', odm=odm_filename):
+            book = _parse_odm(odm_filename)
+        _write_book_cache(cache_path, st, book)
+    with _books_lock:
+        _books[key] = book
+    return book
+
+def _read_book_cache(cache_path, st):
+    try:
+        with open(cache_path, 'r') as fd:
+            cached = json.load(fd)
+        if cached['version'] == ODM_CACHE_VERSION \
+                and cached['mtime_ns'] == st.st_mtime_ns \
+                and cached['size'] == st.st_size:
+            logging.debug('Using cached ODM data {}'.format(cache_path))
+            return _Book.from_dict(cached['book'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def _write_book_cache(cache_path, st, book):
+    try:
+        os.makedirs(dirname(cache_path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump({
+                'version': ODM_CACHE_VERSION,
+                'mtime_ns': st.st_mtime_ns,
+                'size': st.st_size,
+                'book': book.to_dict()}, fd)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.debug('Could not write ODM cache {}: {}'.format(cache_path, e))
+
+def _parse_odm(odm_filename):
+    logging.debug('Parsing ODM file {}'.format(odm_filename))
+    book = _Book()
+    book.odm_filename = odm_filename
+    book.acquisition_url = book.expiration_date = book.library = None
+    book.base_url = ''
+    book.num_parts = 0
+    book.parts = []
+    root = None
+    metadata = None
+    # Stream through the ODM file once, picking out what is needed
+    path = []
+    for event, elem in ET.iterparse(odm_filename, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            path.append(elem.tag)
+            continue
+        path.pop()
+        tag = elem.tag
+        if tag == 'AcquisitionUrl' and path[-1:] == ['License']:
+            book.acquisition_url = elem.text
+        elif tag == 'Protocol' and elem.get('method') == 'download' \
+                and not book.base_url:
+            book.base_url = elem.get('baseurl', default='')
+        elif tag == 'Parts':
+            book.num_parts = int(elem.get('count', default=0))
+        elif tag == 'Part':
+            book.parts.append(_Part(
+                int(elem.get('number')),
+                elem.get('name'),
+                elem.get('filename'),
+                int(elem.get('filesize')),
+                elem.get('duration')))
+        elif tag == 'ExpirationDate' and book.expiration_date is None:
+            book.expiration_date = elem.text
+        elif tag == 'Name' and path[-1:] == ['Source'] \
+                and book.library is None:
+            book.library = elem.text
+        elif tag == 'Metadata':
+            metadata = elem
+    book.media_id = root.attrib.get('id', '')
+    if metadata is None:
+        # Metadata is usually embedded as CDATA text next to the License
+        for text in [root.text] + [child.tail for child in root]:
+            m = re.search(r'<Metadata>.*</Metadata>', text or '', flags=re.S)
+            if m:
+                # escape standalone ampersands
+                metadata = ET.fromstring(re.sub(r' & ', ' &amp; ', m.group(0)))
+                break
+    if metadata is None:
         _die('Could not find Metadata in {}'.format(odm_filename))
-    # escape standalone ampersands
-    metadata_str = re.sub(r' & ', ' &amp; ', m.group(0))
-    metadata = ET.fromstring(metadata_str)
-    return root, metadata
+    book.author = _get_author_from_metadata(metadata)
+    book.title = metadata.findtext('Title')
+    book.content_type = metadata.findtext('ContentType')
+    book.publisher = metadata.findtext('Publisher')
+    book.subjects = ', '.join([e.text for e in metadata.findall('.//Subject')])
+    book.language = ', '.join(
+            [e.text for e in metadata.findall('.//Language')])
+    book.description = metadata.findtext('Description', '')
+    book.cover_url = metadata.findtext('CoverUrl', '')
+    return book
+
+def _cache_dir():
+    return abspath(expanduser(config.get('cache_dir', CACHE_DIR)))
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning('Could not remove {}: {}'.format(path, e))
 
 def _get_author_from_metadata(metadata):
     creator_elements = metadata.findall('.//Creator')
@@ -276,43 +2163,553 @@ def _get_author_from_metadata(metadata):
         author = ';'.join([e.text for e in author_elements])
     return author
 
-def _update_tags(tags_to_update, download_dir, num_parts):
+class _Index(object):
+    """SQLite index of the books in the library, keyed on ODM media id and
+    updated as parts finish, so questions about what has been downloaded do
+    not need to walk the download directory."""
+
+    def __init__(self, path):
+        os.makedirs(dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.executescript(INDEX_SCHEMA)
+
+    def record_book(self, book, download_dir):
+        with self._lock, self._conn:
+            self._conn.execute(
+                    'INSERT INTO books (media_id, odm, author, title, path,'
+                    ' num_parts, expiration_date, updated)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                    ' ON CONFLICT (media_id) DO UPDATE SET odm = excluded.odm,'
+                    ' author = excluded.author, title = excluded.title,'
+                    ' path = excluded.path, num_parts = excluded.num_parts,'
+                    ' expiration_date = excluded.expiration_date,'
+                    ' updated = excluded.updated',
+                    (book.media_id, book.odm_filename, book.author, book.title,
+                        download_dir, len(book.parts), book.expiration_date,
+                        time.time()))
+            self._conn.executemany(
+                    'INSERT OR IGNORE INTO parts (media_id, number, filename,'
+                    ' expected_size, complete) VALUES (?, ?, ?, ?, 0)',
+                    [(book.media_id, part.number,
+                        DOWNLOAD_FILENAME_FORMAT.format(number=part.number),
+                        part.filesize) for part in book.parts])
+
+    def record_part(self, media_id, number, entry):
+        with self._lock, self._conn:
+            self._conn.execute(
+                    'UPDATE parts SET size = ?, sha256 = ?, complete = 1,'
+                    ' updated = ? WHERE media_id = ? AND number = ?',
+                    (entry.get('size'), entry.get('sha256'), time.time(),
+                        media_id, number))
+
+    def remove_part(self, media_id, number):
+        with self._lock, self._conn:
+            self._conn.execute(
+                    'UPDATE parts SET complete = 0, updated = ?'
+                    ' WHERE media_id = ? AND number = ?',
+                    (time.time(), media_id, number))
+
+    def set_state(self, media_id, column):
+        # column is one of the *_updated timestamps of the books table
+        with self._lock, self._conn:
+            self._conn.execute(
+                    'UPDATE books SET {} = ? WHERE media_id = ?'.format(column),
+                    (time.time(), media_id))
+
+    def book_status(self, media_id):
+        with self._lock:
+            row = self._conn.execute(
+                    'SELECT b.path, b.num_parts, b.expiration_date,'
+                    ' b.tags_updated, b.owner_updated,'
+                    ' (SELECT COUNT(*) FROM parts p WHERE p.media_id ='
+                    ' b.media_id AND p.complete) FROM books b'
+                    ' WHERE b.media_id = ?', (media_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('path', 'num_parts', 'expiration_date',
+            'tags_updated', 'owner_updated', 'complete_parts'), row))
+
+    def missing(self):
+        with self._lock:
+            rows = self._conn.execute(
+                    'SELECT b.author, b.title, b.path, b.odm,'
+                    ' b.expiration_date, GROUP_CONCAT(p.number) FROM books b'
+                    ' JOIN parts p ON p.media_id = b.media_id'
+                    ' WHERE NOT p.complete GROUP BY b.media_id'
+                    ' ORDER BY b.author, b.title').fetchall()
+        return [(author, title, path, odm, expiration_date,
+            sorted(int(n) for n in numbers.split(',')))
+            for author, title, path, odm, expiration_date, numbers in rows]
+
+def _get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = _Index(abspath(expanduser(config.get('index_file',
+                join(_cache_dir(), INDEX_FILENAME)))))
+        return _index
+
+def print_missing():
+    missing = _get_index().missing()
+    for author, title, path, odm, expiration_date, numbers in missing:
+        print('{} - {}: missing part{} {} (expires {})\n  {}\n  {}'.format(
+            ', '.join(author.split(';')), title,
+            '' if len(numbers) == 1 else 's',
+            ', '.join(str(n) for n in numbers),
+            expiration_date, path, odm))
+    return missing
+
+class _Manifest(object):
+    """Record of the parts downloaded into a book's directory, with their
+    size, modification time, SHA-256 and HTTP validators."""
+
+    def __init__(self, download_dir):
+        self.path = join(download_dir, MANIFEST_FILENAME)
+        self.odm = None
+        self.media_id = None
+        # part number (as a string) -> entry from _manifest_entry
+        self.parts = {}
+        try:
+            with open(self.path, 'r') as fd:
+                data = json.load(fd)
+            self.odm = data.get('odm')
+            self.media_id = data.get('media_id')
+            self.parts = data.get('parts', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable manifest {}: {}'.format(
+                self.path, e))
+
+    def is_complete(self, number, filepath):
+        # A part is complete if it has not changed since it was recorded.
+        # Checking its content is left to --verify.
+        entry = self.parts.get(str(number))
+        if not entry:
+            return False
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return False
+        return st.st_size == entry['size'] \
+                and st.st_mtime_ns == entry['mtime_ns']
+
+    def save(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump({
+                'version': MANIFEST_VERSION,
+                'odm': self.odm,
+                'media_id': self.media_id,
+                'parts': self.parts}, fd, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+def _manifest_entry(filepath, sha256):
+    st = os.stat(filepath)
+    return {'filename': basename(filepath),
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha256': sha256}
+
+def _hash_file(filepath):
+    hasher = hashlib.sha256()
+    try:
+        with open(filepath, 'rb') as fd:
+            for block in iter(lambda: fd.read(HASH_BLOCK_SIZE), b''):
+                hasher.update(block)
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+def verify_library(pool, **download_options):
+    from concurrent.futures import ProcessPoolExecutor
+    library_dir = abspath(expanduser(config['download_dir']))
+    logging.info('Verifying downloaded parts in {}'.format(library_dir))
+    manifests = [_Manifest(dir_path)
+            for dir_path, _, filenames in os.walk(library_dir)
+            if MANIFEST_FILENAME in filenames]
+    num_parts = 0
+    failed = {}
+    # Hashing is CPU bound, so spread it over processes
+    with ProcessPoolExecutor() as executor:
+        futures = {}
+        for manifest in manifests:
+            for number, entry in manifest.parts.items():
+                filepath = join(dirname(manifest.path), entry['filename'])
+                futures[executor.submit(_hash_file, filepath)] = \
+                        (manifest, number, filepath)
+        for future in as_completed(futures):
+            manifest, number, filepath = futures[future]
+            num_parts += 1
+            if future.result() != manifest.parts[number]['sha256']:
+                logging.warning('Verification failed for {}'.format(filepath))
+                failed.setdefault(manifest, []).append((number, filepath))
+    odm_filenames = []
+    unrecoverable = []
+    for manifest, bad_parts in failed.items():
+        # Remove the bad parts so that only they are downloaded again
+        for number, filepath in bad_parts:
+            if isfile(filepath):
+                os.remove(filepath)
+            del manifest.parts[number]
+            if manifest.media_id:
+                _get_index().remove_part(manifest.media_id, int(number))
+        manifest.save()
+        if manifest.odm and isfile(manifest.odm):
+            odm_filenames.append(manifest.odm)
+        else:
+            unrecoverable.append(dirname(manifest.path))
+    print('Verified {} parts of {} books, {} failed'.format(
+        num_parts, len(manifests), sum(len(p) for p in failed.values())))
+    for dir_path in unrecoverable:
+        print('Cannot download again, ODM file missing: {}'.format(dir_path))
+    if odm_filenames:
+        report = download_audiobooks(odm_filenames, pool, **download_options)
+        report.print_summary()
+        return not (report.failures or report.skipped or unrecoverable)
+    return not unrecoverable
+
+def _update_tags(tags_to_update, book, download_dir, jobs):
+    tagger = _Tagger(tags_to_update, book, _Manifest(download_dir), jobs)
+    for part in book.parts:
+        tagger.submit(part.number, join(download_dir,
+            DOWNLOAD_FILENAME_FORMAT.format(number=part.number)))
+    tagger.wait()
+
+class _Tagger(object):
+    """Updates the ID3 tags of parts on a thread pool. Files whose tags
+    already match are left alone."""
+
+    def __init__(self, tags_to_update, book, manifest, jobs,
+            on_tagged=None):
+        self.tags_to_update = tags_to_update
+        self.book = book
+        self.manifest = manifest
+        # Called with the number and path of each part once it is tagged
+        self.on_tagged = on_tagged
+        self._executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self._futures = {}
+
+    def submit(self, number, filepath):
+        tags = _part_tags(self.tags_to_update, self.book, number)
+        future = self._executor.submit(_profiled, self._tag, number,
+                filepath, tags, str(number) in self.manifest.parts)
+        self._futures[future] = number
+
+    def _tag(self, number, filepath, tags, in_manifest):
+        entry = _tag_part(filepath, tags, in_manifest)
+        if self.on_tagged:
+            self.on_tagged(number, filepath)
+        return entry
+
+    def wait(self):
         logging.info('Updating ID3 tags')
-        for part in range(1, num_parts+1):
-            filepath = download_dir \
-                    + sep \
-                    + DOWNLOAD_FILENAME_FORMAT.format(
-                        number=part)
-            logging.debug('Updating tag for {}'.format(filepath))
+        num_updated = 0
+        try:
+            for future in as_completed(self._futures):
+                entry = future.result()
+                if entry is None:
+                    continue
+                num_updated += 1
+                number = str(self._futures[future])
+                if number in self.manifest.parts:
+                    self.manifest.parts[number].update(entry)
+                    # Tagging changed the part's size and checksum
+                    _get_index().record_part(self.book.media_id,
+                            int(number), self.manifest.parts[number])
+        finally:
+            self._executor.shutdown()
+        if num_updated:
+            self.manifest.save()
+        logging.info('Updated ID3 tags of {} of {} parts'.format(
+            num_updated, len(self._futures)))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def _part_tags(tags_to_update, book, number):
+    tags = {'tracknumber': '{}/{}'.format(number, len(book.parts))}
+    for part in book.parts:
+        if part.number == number and part.name:
+            tags['title'] = part.name
+    return _book_tags(tags_to_update, book, **tags)
+
+def _book_tags(tags_to_update, book, **tags):
+    tags = dict({'album': book.title, 'artist': book.author.split(';')},
+            **tags)
+    # Tags from the configuration take precedence
+    tags.update(tags_to_update)
+    # EasyID3 returns every value as a list of strings
+    return {key: [str(v) for v in value]
+            if isinstance(value, (list, tuple)) else [str(value)]
+            for key, value in tags.items()}
+
+def _tag_part(filepath, tags, in_manifest):
+    from mutagen.easyid3 import EasyID3
+    from mutagen.id3 import ID3NoHeaderError
+    with _timed('tag', file=filepath) as fields:
+        try:
             tag = EasyID3(filepath)
-            for key in tags_to_update:
-                tag[key] = tags_to_update[key]
-            tag.save()
+        except ID3NoHeaderError:
+            tag = EasyID3()
+        fields['updated'] = False
+        if all(tag.get(key) == value for key, value in tags.items()):
+            logging.debug('Tags of {} are up to date'.format(filepath))
+            return None
+        logging.debug('Updating tag for {}'.format(filepath))
+        for key, value in tags.items():
+            tag[key] = value
+        tag.save(filepath)
+        fields['updated'] = True
+        # The new tag changes the file, so record its new checksum
+        return _manifest_entry(filepath, _hash_file(filepath)) \
+                if in_manifest else {}
 
-def _update_tags_only(tags_to_update, odm_filename):
-    _verify_odm_file(odm_filename)
-    author, title, _, _, parts = _extract_author_title_urls_parts(odm_filename)
+def _update_tags_only(tags_to_update, odm_filename, jobs=1):
+    book = _load_book(odm_filename)
+    author, title, _, _, parts = _extract_author_title_urls_parts(book)
     num_parts = len(parts)
     download_dir = _construct_download_dir_path(author, title)
     _die_if_missing_files(download_dir, num_parts)
-    _update_tags(tags_to_update, download_dir, num_parts)
+    _update_tags(tags_to_update, book, download_dir, jobs)
+    _get_index().set_state(book.media_id, 'tags_updated')
 
-def _update_owner(user, group, download_dir, num_parts, title):
-    logging.info('Updating file owner info')
-    if user:
-        try:
-            user_id = pwd.getpwnam(user).pw_uid
-        except KeyError:
-            user_id = -1
-    else:
-        user_id = -1
-    if group:
+class _Merger(object):
+    """Joins the parts of a book into a single MP3 file with a chapter for
+    each part. Each part is appended as soon as it and the parts before it
+    are available, copying the audio as it is without decoding it."""
+
+    def __init__(self, book, download_dir, title):
+        self.book = book
+        self.filepath = join(download_dir,
+                MERGED_FILENAME_FORMAT.format(title=title))
+        self.cover_path = join(download_dir,
+                COVER_FILENAME_FORMAT.format(title=title))
+        self._partial = self.filepath + PARTIAL_SUFFIX
+        # Appending happens on a single thread, in the order of the parts
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+        self._ready = {}
+        self._pending = deque(part.number for part in book.parts)
+        self._durations = {part.number: _parse_duration(part.duration)
+                for part in book.parts}
+        self._measured = False
+        self._closed = False
+        self._fd = None
+        self._bytes = 0
+        self._seconds = 0.0
+
+    def submit(self, number, filepath):
+        if self._closed:
+            return
+        self._futures.append(self._executor.submit(
+                _profiled, self._add, number, filepath))
+
+    def _add(self, number, filepath):
+        self._ready[number] = filepath
+        while self._pending and self._pending[0] in self._ready:
+            number = self._pending.popleft()
+            self._append(number, self._ready.pop(number))
+
+    def _append(self, number, filepath):
+        from mutagen.mp3 import MP3, HeaderNotFoundError
+        start_time = time.monotonic()
+        if self._fd is None:
+            self._start()
+        logging.debug('Appending {} to {}'.format(filepath, self._partial))
+        with open(filepath, 'rb') as f:
+            start, end = _audio_range(f.fileno())
+            _append_range(f.fileno(), self._fd, start, end - start)
+        self._bytes += end - start
+        if self._durations[number] is None:
+            # Chapters need the length of every part before them, so ask
+            # the file when the ODM file does not say
+            try:
+                self._durations[number] = MP3(filepath).info.length
+            except HeaderNotFoundError:
+                logging.warning('Could not find the duration of {}'.format(
+                    filepath))
+                self._durations[number] = 0
+            self._measured = True
+        self._seconds += time.monotonic() - start_time
+
+    def _start(self):
+        from mutagen.easyid3 import EasyID3
+        from mutagen.id3 import APIC, ID3
+        # The tag goes first, with the chapters of parts whose duration is
+        # not known yet filled in once they are appended
+        open(self._partial, 'wb').close()
+        tag = EasyID3()
+        for key, value in _book_tags(config.get('tags', {}), self.book,
+                title=self.book.title).items():
+            tag[key] = value
+        tag.save(self._partial, v2_version=3)
+        tag = ID3(self._partial)
+        self._add_chapters(tag)
+        if _file_exists(self.cover_path):
+            with open(self.cover_path, 'rb') as f:
+                tag.add(APIC(encoding=3, mime='image/jpeg', type=3,
+                        desc='Cover', data=f.read()))
+        tag.save(self._partial, v2_version=3)
+        self._fd = os.open(self._partial, os.O_WRONLY)
+        os.lseek(self._fd, 0, os.SEEK_END)
+
+    def _add_chapters(self, tag):
+        from mutagen.id3 import CHAP, CTOC, CTOCFlags, TIT2
+        tag.delall('CTOC')
+        tag.delall('CHAP')
+        element_ids = ['ch{}'.format(part.number) for part in self.book.parts]
+        tag.add(CTOC(element_id='toc',
+                flags=CTOCFlags.TOP_LEVEL | CTOCFlags.ORDERED,
+                child_element_ids=element_ids,
+                sub_frames=[TIT2(encoding=3, text=[self.book.title])]))
+        position = 0.0
+        for part, element_id in zip(self.book.parts, element_ids):
+            start = int(round(position * 1000))
+            position += self._durations[part.number] or 0
+            tag.add(CHAP(element_id=element_id,
+                    start_time=start,
+                    end_time=int(round(position * 1000)),
+                    start_offset=0xFFFFFFFF,
+                    end_offset=0xFFFFFFFF,
+                    sub_frames=[TIT2(encoding=3,
+                        text=[part.name or element_id])]))
+
+    def wait(self):
+        logging.info('Merging {} parts into {}'.format(
+            len(self.book.parts), self.filepath))
         try:
-            group_id = grp.getgrnam(group).gr_gid
-        except KeyError:
-            group_id = -1
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        if self._pending:
+            logging.error('Not merging {}: part {} is missing'.format(
+                self.filepath, self._pending[0]))
+            return
+        if self._measured:
+            from mutagen.id3 import ID3
+            # The chapters take up as much room as before, so the tag is
+            # rewritten in place
+            tag = ID3(self._partial)
+            self._add_chapters(tag)
+            tag.save(self._partial, v2_version=3)
+        os.replace(self._partial, self.filepath)
+        _record_metric('merge', self._seconds, file=self.filepath,
+                bytes=self._bytes)
+        logging.info('Merged {} parts into {}'.format(
+            len(self.book.parts), self.filepath))
+
+    def shutdown(self):
+        self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def _audio_range(fd):
+    """Where the audio of an MP3 file starts and ends, leaving out its ID3
+    tags and any Xing, Info or VBRI frame, whose frame count and duration
+    would be those of this file alone."""
+    size = os.fstat(fd).st_size
+    start = 0
+    while True:
+        header = os.pread(fd, 10, start)
+        if len(header) < 10 or header[:3] != b'ID3':
+            break
+        # The tag size is a syncsafe integer, not counting the header
+        # itself or the footer
+        start += 10 + (header[6] << 21 | header[7] << 14
+                | header[8] << 7 | header[9])
+        if header[5] & 0x10:
+            start += 10
+    start = min(start, size)
+    start = min(start + _info_frame_size(fd, start), size)
+    end = size
+    if end - start >= 128 and os.pread(fd, 3, end - 128) == b'TAG':
+        end -= 128
+    return start, end
+
+def _info_frame_size(fd, offset):
+    """Size of the Xing, Info or VBRI frame at offset in an MP3 file, or 0
+    when the frame there is one of audio."""
+    data = os.pread(fd, 4 + 32 + 4, offset)
+    if len(data) < 40 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return 0
+    version = data[1] >> 3 & 3
+    layer = data[1] >> 1 & 3
+    bitrate_index = data[2] >> 4
+    sample_rate_index = data[2] >> 2 & 3
+    # Only layer III with a known bitrate and sample rate, as the frame size
+    # of free format frames is not in the header
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) \
+            or sample_rate_index == 3:
+        return 0
+    mono = data[3] >> 6 == 3
+    if version == 3:
+        side_info = 17 if mono else 32
     else:
-        group_id = -1
+        side_info = 9 if mono else 17
+    if data[4 + side_info:8 + side_info] not in (b'Xing', b'Info') \
+            and data[36:40] != b'VBRI':
+        return 0
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = data[2] >> 1 & 1
+    return (144 if version == 3 else 72) * bitrate // sample_rate + padding
+
+def _append_range(src_fd, dst_fd, offset, count):
+    """Appends count bytes at offset in one file to another, copying
+    them within the kernel when the filesystem allows it."""
+    end = offset + count
+    try:
+        while offset < end:
+            copied = os.copy_file_range(src_fd, dst_fd, end - offset, offset)
+            if not copied:
+                break
+            offset += copied
+    except (AttributeError, OSError):
+        # Not available on this system or across these filesystems
+        pass
+    while offset < end:
+        data = os.pread(src_fd, min(HASH_BLOCK_SIZE, end - offset), offset)
+        if not data:
+            raise IOError('File ended {} bytes short of {}'.format(
+                end - offset, end))
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        offset += len(data)
+
+def _parse_duration(duration):
+    """Seconds in an ODM part duration (e.g. 01:02:03.5), or None."""
+    try:
+        seconds = 0.0
+        for field in duration.split(':'):
+            seconds = seconds * 60 + float(field)
+        return seconds
+    except (AttributeError, ValueError):
+        return None
+
+def _merge_only(odm_filename, force=False):
+    book = _load_book(odm_filename)
+    author, title, _, _, parts = _extract_author_title_urls_parts(book)
+    download_dir = _construct_download_dir_path(author, title)
+    _die_if_missing_files(download_dir, len(parts))
+    merger = _Merger(book, download_dir, title)
+    if _file_exists(merger.filepath) and not force:
+        logging.info('Merged file {} already exists'.format(merger.filepath))
+        return
+    for part in parts:
+        merger.submit(part.number, join(download_dir,
+            DOWNLOAD_FILENAME_FORMAT.format(number=part.number)))
+    merger.wait()
+
+def _update_owner(user, group, download_dir, num_parts, title):
+    logging.info('Updating file owner info')
+    user_id, group_id = _owner_ids(user, group)
     # Update owner for author directory
     author_dir = dirname(download_dir)
     logging.debug('Updating owner for {}'.format(author_dir))
@@ -335,14 +2732,111 @@ def _update_owner(user, group, download_dir, num_parts, title):
         logging.debug('Updating owner for cover image: {}'.format(
             cover_path))
         os.chown(cover_path, user_id, group_id)
+    # Update owner info for merged file
+    merged_path = join(download_dir, MERGED_FILENAME_FORMAT.format(title=title))
+    if os.path.isfile(merged_path):
+        logging.debug('Updating owner for merged file: {}'.format(
+            merged_path))
+        os.chown(merged_path, user_id, group_id)
+
+@functools.lru_cache()
+def _owner_ids(user, group):
+    """uid and gid of a user and group, -1 for either one that is not given
+    or does not exist."""
+    user_id = group_id = -1
+    if user:
+        try:
+            user_id = pwd.getpwnam(user).pw_uid
+        except KeyError:
+            pass
+    if group:
+        try:
+            group_id = grp.getgrnam(group).gr_gid
+        except KeyError:
+            pass
+    return user_id, group_id
+
+def fix_library_owner(jobs):
+    """Gives everything in the download directory the configured owner,
+    group and file and directory modes, leaving alone whatever already has
+    them. Directories are scanned and fixed on a thread pool."""
+    owner = config['owner']
+    user_id, group_id = _owner_ids(owner.get('user'), owner.get('group'))
+    file_mode = _parse_mode(owner.get('file_mode'))
+    dir_mode = _parse_mode(owner.get('dir_mode'))
+    library_dir = abspath(expanduser(config['download_dir']))
+    logging.info('Fixing owner of {}'.format(library_dir))
+    counts = dict.fromkeys(('dirs', 'files', 'owner', 'mode', 'errors'), 0)
+    with _timed('chown', directory=library_dir), \
+            ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        pending = {executor.submit(_fix_owner_in_dir, library_dir, user_id,
+            group_id, file_mode, dir_mode)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_counts, subdirs = future.result()
+                for key, count in dir_counts.items():
+                    counts[key] += count
+                pending.update(executor.submit(_fix_owner_in_dir, subdir,
+                    user_id, group_id, file_mode, dir_mode)
+                    for subdir in subdirs)
+    print('Checked {dirs} directories and {files} files: changed the owner'
+            ' of {owner} and the mode of {mode}, {errors} failed'.format(
+                **counts))
+    return not counts['errors']
+
+def _fix_owner_in_dir(dir_path, user_id, group_id, file_mode, dir_mode):
+    # Fixes the entries of one directory, returning what it counted and the
+    # subdirectories still to be fixed
+    counts = dict.fromkeys(('dirs', 'files', 'owner', 'mode', 'errors'), 0)
+    subdirs = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        counts['dirs'] += 1
+                        subdirs.append(entry.path)
+                        mode = dir_mode
+                    else:
+                        counts['files'] += 1
+                        mode = file_mode
+                    if (user_id != -1 and st.st_uid != user_id) \
+                            or (group_id != -1 and st.st_gid != group_id):
+                        logging.debug('Updating owner for {}'.format(
+                            entry.path))
+                        os.chown(entry.path, user_id, group_id)
+                        counts['owner'] += 1
+                    if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+                        logging.debug('Updating mode for {}'.format(
+                            entry.path))
+                        os.chmod(entry.path, mode)
+                        counts['mode'] += 1
+                except OSError as e:
+                    logging.warning('Could not fix owner of {}: {}'.format(
+                        entry.path, e))
+                    counts['errors'] += 1
+    except OSError as e:
+        logging.warning('Could not read {}: {}'.format(dir_path, e))
+        counts['errors'] += 1
+    return counts, subdirs
+
+def _parse_mode(mode):
+    # Modes are given as octal strings such as "0644"
+    return int(mode, 8) if isinstance(mode, str) else mode
 
 def _update_owner_only(user, group, odm_filename):
-    _verify_odm_file(odm_filename)
-    author, title, _, _, parts = _extract_author_title_urls_parts(odm_filename)
+    book = _load_book(odm_filename)
+    author, title, _, _, parts = _extract_author_title_urls_parts(book)
     num_parts = len(parts)
     download_dir = _construct_download_dir_path(author, title)
     _die_if_missing_files(download_dir, num_parts)
-    _update_owner(user, group, download_dir, num_parts, title)
+    with _timed('chown', directory=download_dir):
+        _update_owner(user, group, download_dir, num_parts, title)
+    _get_index().set_state(book.media_id, 'owner_updated')
 
 def _construct_download_dir_path(author, title):
     return abspath(expanduser(config['download_dir'])
@@ -352,6 +2846,22 @@ def _construct_download_dir_path(author, title):
                     title=title,
                     filename=''))
 
+def _expand_odm_filenames(patterns):
+    odm_filenames = []
+    for pattern in patterns:
+        path = abspath(expanduser(pattern))
+        if isdir(path):
+            matches = glob.glob(join(glob.escape(path), '*.odm'))
+        elif glob.has_magic(path):
+            matches = glob.glob(path)
+        else:
+            # Let _verify_odm_file complain about missing files
+            matches = [path]
+        for odm_filename in sorted(matches):
+            if odm_filename not in odm_filenames:
+                odm_filenames.append(odm_filename)
+    return odm_filenames
+
 def _file_exists(file_path, expected_size_bytes=None):
     does_file_exist = isfile(file_path) \
             and (expected_size_bytes is None
@@ -389,18 +2899,75 @@ def _verify_odm_file(odm_filename):
         _die('Expected ODM file. Specified file "{}"'
                 ' does not exist'.format(basename(odm_filename)))
 
-def _get_license_and_client_id(odm_filename):
-    license = ''
-    license_filepath = odm_filename + '.license'
-    if not isfile(license_filepath):
-        license = acquire_license(odm_filename)
-        logging.debug('Writing to license file: {}'.format(license_filepath))
-        with open(license_filepath, 'w') as fd:
-            fd.write(license)
-    else:
-        logging.debug('Reading from license file: {}'.format(license_filepath))
-        with open(license_filepath, 'r') as fd:
-            license = fd.read()
+def _get_license_and_client_id(book):
+    with _license_lock(book.media_id):
+        stored = _licenses.get(book.media_id)
+        if stored is None:
+            stored = _read_stored_license(book)
+        if stored is None:
+            # Licenses used to be kept next to each ODM file
+            legacy_filepath = book.odm_filename + '.license'
+            if isfile(legacy_filepath):
+                logging.debug('Reading from license file: {}'.format(
+                    legacy_filepath))
+                with open(legacy_filepath, 'r') as fd:
+                    stored = _store_license(book, fd.read())
+        if stored is None:
+            stored = _store_license(book, acquire_license(book))
+        _licenses[book.media_id] = stored
+    return (stored['license'], stored['client_id'])
+
+def _renew_license(book, rejected_license):
+    with _license_lock(book.media_id):
+        stored = _licenses.get(book.media_id)
+        # Another part of the book may already have renewed it
+        if stored is None or stored['license'] == rejected_license:
+            stored = _store_license(book, acquire_license(book))
+            _licenses[book.media_id] = stored
+    return (stored['license'], stored['client_id'])
+
+def _prefetch_license(odm_filename):
+    try:
+        _get_license_and_client_id(_load_book(odm_filename))
+    except (Exception, SystemExit):
+        # Reported again when the book itself is downloaded
+        pass
+
+def _license_headers(license, client_id):
+    return {
+        'License': license,
+        'ClientID': client_id,
+        'User-Agent': USER_AGENT
+        }
+
+def _license_lock(media_id):
+    with _licenses_lock:
+        if media_id not in _license_locks:
+            _license_locks[media_id] = threading.Lock()
+        return _license_locks[media_id]
+
+def _license_store_path(media_id):
+    return join(_cache_dir(), LICENSE_STORE_DIR,
+            re.sub(r'[^\w.-]', '_', media_id) + '.json')
+
+def _read_stored_license(book):
+    store_path = _license_store_path(book.media_id)
+    try:
+        with open(store_path, 'r') as fd:
+            stored = json.load(fd)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning('Ignoring unreadable license {}: {}'.format(
+            store_path, e))
+        return None
+    if stored.get('expires') and stored['expires'] <= time.time():
+        logging.info('Stored license for {} has expired'.format(book.title))
+        return None
+    logging.debug('Using stored license {}'.format(store_path))
+    return stored
+
+def _store_license(book, license):
     if not license:
         _die('Missing license content')
     license_xml = ET.fromstring(license)
@@ -409,32 +2976,70 @@ def _get_license_and_client_id(odm_filename):
             '/{http://license.overdrive.com/2008/03/License.xsd}ClientID')
     if not client_id:
         _die('Failed to extract ClientID from License')
-    return (license, client_id)
+    stored = {'license': license,
+            'client_id': client_id,
+            'media_id': book.media_id,
+            'acquired': time.time(),
+            'expires': _parse_expiration(book.expiration_date)}
+    store_path = _license_store_path(book.media_id)
+    logging.debug('Writing to license store: {}'.format(store_path))
+    os.makedirs(dirname(store_path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(store_path, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        json.dump(stored, fd)
+    os.replace(tmp_path, store_path)
+    return stored
+
+def _parse_expiration(expiration_date):
+    # Returns the expiration as a timestamp, or None if it is not known
+    if not expiration_date:
+        return None
+    text = expiration_date.strip()
+    try:
+        expiration = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        expiration = None
+        for date_format in EXPIRATION_DATE_FORMATS:
+            try:
+                expiration = datetime.strptime(text, date_format)
+                break
+            except ValueError:
+                pass
+        if expiration is None:
+            logging.debug('Unrecognized expiration date: {}'.format(text))
+            return None
+    return expiration.timestamp()
+
+def _get_client_id():
+    global _client_id
+    with _licenses_lock:
+        if _client_id is None:
+            if not isfile(CLIENT_ID_PATH):
+                # Generate random Client ID
+                _client_id = str(uuid.uuid4()).upper()
+                with open(CLIENT_ID_PATH, 'w') as fd:
+                    fd.write(_client_id)
+            else:
+                with open(CLIENT_ID_PATH, 'r') as fd:
+                    _client_id = fd.read()
+        return _client_id
 
+@functools.lru_cache(maxsize=None)
 def _generate_hash(client_id):
     """Hash algorithm and secret complements of
     https://github.com/jvolkening/gloc/blob/v0.601/gloc#L1523-L1531"""
     rawhash = '|'.join([client_id, OMC, OS, HASH_SECRET])
     return base64.b64encode(hashlib.sha1(rawhash.encode('utf-16-le')).digest())
 
-def acquire_license(odm_filename):
+def acquire_license(book):
+    import requests
     logging.debug('Acquiring license')
-    tree = ET.parse(odm_filename)
-    root = tree.getroot()
-    acquisition_url = root.findtext('./License/AcquisitionUrl')
+    acquisition_url = book.acquisition_url
     logging.debug('Using AcquisitionUrl: {}'.format(acquisition_url))
-    media_id = root.attrib.get('id', '')
+    media_id = book.media_id
     logging.debug('Using MediaID: {}'.format(media_id))
 
-    client_id = ''
-    if not isfile(CLIENT_ID_PATH):
-        # Generate random Client ID
-        client_id = str(uuid.uuid4()).upper()
-        with open(CLIENT_ID_PATH, 'w') as fd:
-            fd.write(client_id)
-    else:
-        with open(CLIENT_ID_PATH, 'r') as fd:
-            client_id = fd.read()
+    client_id = _get_client_id()
     logging.debug('Using ClientID: {}'.format(client_id))
 
     hsh = _generate_hash(client_id)
@@ -447,11 +3052,167 @@ def acquire_license(odm_filename):
         'OMC': OMC,
         'OS': OS,
         'Hash': hsh}
-    r = requests.get(acquisition_url, params=payload, headers=headers)
+    try:
+        with _timed('license', media_id=media_id):
+            r = _http_get(acquisition_url, params=payload, headers=headers)
+    except requests.RequestException as e:
+        _die('Failed to acquire License for {}: {}'.format(
+            book.odm_filename, e))
     if r.status_code == 200:
         return r.text
     else:
-        _die('Failed to acquire License for {}'.format(odm_filename))
+        _die('Failed to acquire License for {}'.format(book.odm_filename))
+
+def _setup_session(pool_size):
+    import requests
+    global _session
+    with _session_lock:
+        _session = requests.Session()
+        # Keep enough connections alive for every concurrent download
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=max(1, pool_size))
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+def _get_session():
+    with _session_lock:
+        session = _session
+    return session if session is not None else _setup_session(1)
+
+def _http_get(url, on_retry=None, **kwargs):
+    import requests
+    kwargs.setdefault('timeout', (_http_config('connect_timeout'),
+        _http_config('timeout')))
+    attempt = 0
+    while True:
+        try:
+            r = _get_session().get(url, **kwargs)
+            if r.status_code not in RETRY_STATUS_CODES \
+                    or attempt >= _http_config('retries'):
+                return r
+            reason = 'status code {}'.format(r.status_code)
+            retry_after = r.headers.get('Retry-After', '')
+            r.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= _http_config('retries'):
+                raise
+            reason = str(e)
+            retry_after = ''
+        delay = _backoff_delay(attempt)
+        if retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        logging.warning('Request to {} failed ({}), retrying in {:.1f}s'.format(
+            url, reason, delay))
+        if on_retry is not None:
+            on_retry()
+        time.sleep(delay)
+        attempt += 1
+
+def _backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(_http_config('backoff_max'),
+        _http_config('backoff') * 2 ** attempt))
+
+def _http_config(key):
+    return config.get('http', {}).get(key, HTTP_DEFAULTS[key])
+
+@contextmanager
+def _timed(stage, **fields):
+    # Records the time spent in the block, along with any fields the block
+    # adds to the dict it is given
+    start_time = time.monotonic()
+    try:
+        yield fields
+    except BaseException:
+        fields['failed'] = True
+        raise
+    finally:
+        _record_metric(stage, time.monotonic() - start_time, **fields)
+
+def _record_metric(stage, seconds, **fields):
+    event = OrderedDict([
+        ('time', round(time.time(), 3)),
+        ('stage', stage),
+        ('seconds', round(seconds, 6))])
+    event.update(fields)
+    metrics_file = config.get('metrics_file')
+    with _metrics_lock:
+        totals = _metrics.setdefault(stage,
+                {'count': 0, 'seconds': 0.0, 'bytes': 0, 'retries': 0})
+        totals['count'] += 1
+        totals['seconds'] += seconds
+        totals['bytes'] += fields.get('bytes') or 0
+        totals['retries'] += fields.get('retries') or 0
+        if metrics_file:
+            with open(expanduser(metrics_file), 'a') as fd:
+                fd.write(json.dumps(event) + '\n')
+
+def _write_prometheus_metrics():
+    # Written once at exit, in the format of the node exporter's textfile
+    # collector
+    prometheus_file = config.get('prometheus_file')
+    if not prometheus_file:
+        return
+    prometheus_file = expanduser(prometheus_file)
+    lines = []
+    for name, key, metric_type, description in (
+            ('stage_seconds_total', 'seconds', 'counter',
+                'Seconds spent in each stage'),
+            ('stage_runs_total', 'count', 'counter',
+                'Number of times each stage ran'),
+            ('stage_bytes_total', 'bytes', 'counter',
+                'Bytes downloaded in each stage'),
+            ('stage_retries_total', 'retries', 'counter',
+                'Requests retried in each stage')):
+        lines.append('# HELP {}{} {}'.format(
+            METRICS_PREFIX, name, description))
+        lines.append('# TYPE {}{} {}'.format(METRICS_PREFIX, name, metric_type))
+        with _metrics_lock:
+            for stage, totals in _metrics.items():
+                lines.append('{}{}{{stage="{}"}} {}'.format(
+                    METRICS_PREFIX, name, stage, totals[key]))
+    lines.append('# HELP {}last_run_timestamp_seconds'
+            ' Time the last run finished'.format(METRICS_PREFIX))
+    lines.append('# TYPE {}last_run_timestamp_seconds gauge'.format(
+        METRICS_PREFIX))
+    lines.append('{}last_run_timestamp_seconds {:.3f}'.format(
+        METRICS_PREFIX, time.time()))
+    tmp_path = '{}.{}.tmp'.format(prometheus_file, os.getpid())
+    with open(tmp_path, 'w') as fd:
+        fd.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, prometheus_file)
+
+def _profiled(fn, *args, **kwargs):
+    # cProfile only sees the thread that enabled it, so each thread running
+    # part of the work gets its own profiler, merged at exit
+    if not _profiling:
+        return fn(*args, **kwargs)
+    profiler = getattr(_profile_local, 'profiler', None)
+    if profiler is None:
+        profiler = cProfile.Profile()
+        _profile_local.profiler = profiler
+        with _profilers_lock:
+            _profilers.append(profiler)
+    profiler.enable()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+
+def _write_profile(profile_file):
+    import pstats
+    main_profiler = _profile_local.profiler
+    main_profiler.disable()
+    with _profilers_lock:
+        stats = pstats.Stats(main_profiler)
+        for profiler in _profilers:
+            if profiler is not main_profiler:
+                stats.add(profiler)
+    stats.dump_stats(profile_file)
+    logging.info('Wrote profile to {} (view it with python -m pstats {})'.format(
+        profile_file, profile_file))
 
 def _load_config(config_file):
     global config
@@ -470,6 +3231,8 @@ def _setup_logging(level):
     logging.basicConfig(
             format='%(asctime)s - %(levelname)s - %(message)s',
             level=level)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(_ProgressLogFilter())
 
 def _die(msg):
     sys.stderr.write('ERROR: ' + msg + '\n')
@@ -478,7 +3241,10 @@ def _die(msg):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('filename')
+    parser.add_argument(
+            'filenames', nargs='*', metavar='filename',
+            help='ODM file to process. Several files, directories containing'
+            ' ODM files and glob patterns may be given to process a batch')
     parser.add_argument(
             '-d', '--debug', action='store_true', help='print debug messages')
     parser.add_argument(
@@ -487,11 +3253,15 @@ if __name__ == '__main__':
     parser.add_argument(
             '-o', '--owner', action='store_true',
             help='Update file owner according to configuration')
+    parser.add_argument(
+            '--merge', action='store_true',
+            help='Also join the parts of each book into a single MP3 file'
+            ' with a chapter for each part')
     parser.add_argument(
             '-s', '--skip-download', action='store_true',
             help='Skip downloading files. This option is only valid'
-            ' when updating tags or owner, in which case it is assumed'
-            ' the expected files already exist')
+            ' when updating tags or owner or merging, in which case it is'
+            ' assumed the expected files already exist')
     parser.add_argument(
             '-f', '--force', action='store_true',
             help='Ignore whether audiobook files already exist'
@@ -504,23 +3274,114 @@ if __name__ == '__main__':
     parser.add_argument(
             '-m', '--print-metadata', action='store_true',
             help='Print metadata from specified ODM file and exit')
+    parser.add_argument(
+            '--format', choices=('text', 'json', 'csv'), default='text',
+            help='Output format of \'--print-metadata\': text, or one JSON'
+            ' object per line or one CSV row for each ODM file'
+            ' (default: text)')
+    parser.add_argument(
+            '-j', '--jobs', type=int,
+            help='Number of parts to download at the same time'
+            ' (default: the "jobs" configuration option, or 1)')
+    parser.add_argument(
+            '--missing', action='store_true',
+            help='List the books in the library index that have parts'
+            ' which are not downloaded yet, and exit')
+    parser.add_argument(
+            '--verify', action='store_true',
+            help='Check every downloaded part in the download directory'
+            ' against its recorded checksum and download the parts that'
+            ' fail again')
+    parser.add_argument(
+            '--fix-owner', action='store_true',
+            help='Give everything in the download directory the owner, group'
+            ' and modes from the configuration, and exit')
+    parser.add_argument(
+            '-w', '--watch', metavar='DIR',
+            help='Keep running and download the ODM files that appear in DIR')
+    parser.add_argument(
+            '--daemon', metavar='ADDRESS',
+            help='Keep running and download the books submitted to a JSON'
+            ' API on ADDRESS, a Unix socket path or host:port')
+    parser.add_argument(
+            '--profile', metavar='FILE',
+            help='Profile the run with cProfile and write the statistics'
+            ' to FILE')
     args = parser.parse_args()
     log_level = logging.INFO
     if args.debug:
         log_level = logging.DEBUG
     _setup_logging(log_level)
-    odm_filename = abspath(expanduser(args.filename))
+    if not args.filenames and not args.watch and not args.verify \
+            and not args.missing and not args.daemon and not args.fix_owner:
+        parser.error('at least one filename, \'--watch\', \'--verify\','
+                ' \'--missing\', \'--daemon\' or \'--fix-owner\' is required')
+    if args.fix_owner and (args.filenames or args.watch or args.verify
+            or args.missing or args.daemon or args.print_metadata
+            or args.skip_download):
+        _die('\'--fix-owner\' should be specified without other options')
+    if args.missing and (args.filenames or args.watch or args.verify
+            or args.print_metadata or args.skip_download):
+        _die('\'--missing\' should be specified without other options')
+    if args.verify and (args.filenames or args.watch or args.print_metadata
+            or args.skip_download):
+        _die('\'--verify\' checks the whole download directory and cannot'
+                ' be combined with filenames, \'--watch\', \'--print-metadata\''
+                ' or \'--skip-download\'')
+    if args.daemon and (args.filenames or args.watch or args.verify
+            or args.missing or args.print_metadata or args.skip_download):
+        _die('\'--daemon\' takes its books from the API and cannot be'
+                ' combined with filenames, \'--watch\', \'--verify\','
+                ' \'--missing\', \'--print-metadata\' or'
+                ' \'--skip-download\'')
+    if args.watch and (args.print_metadata or args.skip_download):
+        _die('\'--watch\' cannot be combined with \'--print-metadata\''
+                ' or \'--skip-download\'')
+    odm_filenames = _expand_odm_filenames(args.filenames)
+    # Anything but a single ODM file is a batch and gets a summary report
+    is_batch = len(args.filenames) > 1 \
+            or any(isdir(expanduser(f)) or glob.has_magic(f)
+                    for f in args.filenames)
+    if args.filenames and not odm_filenames:
+        _die('No ODM files found matching {}'.format(' '.join(args.filenames)))
     if args.print_metadata \
-            and (args.tags + args.owner + args.skip_download + args.force) > 0:
+            and (args.tags + args.owner + args.merge + args.skip_download
+                + args.force) > 0:
         _die('\'--print-metadata\' should be specified without other options')
-    if args.skip_download and (args.tags + args.owner == 0):
-        _die('Must include \'--tags\' or \'--owner\' options'
+    if args.format != 'text' and not args.print_metadata:
+        _die('\'--format\' is only valid with \'--print-metadata\'')
+    if args.skip_download and (args.tags + args.owner + args.merge == 0):
+        _die('Must include \'--tags\', \'--owner\' or \'--merge\' options'
                 ' when specifying \'--skip-download\'')
     config_file = args.config if args.config else CONFIG_FILE
     # modifies global config variable with configuration from file
     _load_config(config_file)
+    atexit.register(_write_prometheus_metrics)
+    if args.profile:
+        _profiling = True
+        _profile_local.profiler = cProfile.Profile()
+        _profilers.append(_profile_local.profiler)
+        atexit.register(_write_profile, args.profile)
+        _profile_local.profiler.enable()
+    if args.missing:
+        print_missing()
+        sys.exit(0)
+    if args.fix_owner:
+        if 'owner' not in config:
+            _die('Specified \'--fix-owner\' but no owner information has been'
+                    ' specified in the configuration file {}'.format(
+                        config_file))
+        if not fix_library_owner(
+                args.jobs if args.jobs else config.get('jobs', 1)):
+            sys.exit(1)
+        sys.exit(0)
     if args.print_metadata:
-        print_metadata(odm_filename)
+        if args.format != 'text':
+            if not print_metadata_records(odm_filenames, args.format):
+                sys.exit(1)
+            sys.exit(0)
+        for odm_filename in odm_filenames:
+            print_metadata(odm_filename)
         sys.exit(0)
     if args.skip_download:
         if args.tags and 'tags' not in config:
@@ -531,15 +3392,41 @@ if __name__ == '__main__':
             logging.error('Specified \'--skip-download\' and \'--owner\''
                     ' but no owner information has been specified in the'
                     ' configuration file {}'.format(config_file))
-        if args.tags and 'tags' in config:
-                _update_tags_only(config['tags'], odm_filename)
-        if args.owner and 'owner' in config:
-            _update_owner_only(config['owner'].get('user'),
-                    config['owner'].get('group'),
-                    odm_filename)
+        for odm_filename in odm_filenames:
+            if args.tags and 'tags' in config:
+                    _update_tags_only(config['tags'], odm_filename,
+                            args.jobs if args.jobs else config.get('jobs', 1))
+            if args.merge:
+                _merge_only(odm_filename, force=args.force)
+            if args.owner and 'owner' in config:
+                _update_owner_only(config['owner'].get('user'),
+                        config['owner'].get('group'),
+                        odm_filename)
     else:
-        download_audiobook(
-                odm_filename,
-                update_tags=args.tags,
-                update_owner=args.owner,
-                force_download=args.force)
+        jobs = args.jobs if args.jobs else config.get('jobs', 1)
+        # Segments of a part take slots of the pool, so there are never
+        # more connections than jobs
+        _setup_session(jobs)
+        pool = _DownloadPool(jobs, config.get('per_host_jobs'))
+        download_options = {
+                'update_tags': args.tags,
+                'update_owner': args.owner,
+                'force_download': args.force,
+                'merge': args.merge}
+        if args.verify:
+            if not verify_library(pool, **download_options):
+                sys.exit(1)
+        elif args.daemon:
+            serve_daemon(args.daemon, pool, **download_options)
+        elif args.watch:
+            watch_directory(abspath(expanduser(args.watch)), pool,
+                    config.get('watch_interval', WATCH_INTERVAL),
+                    **download_options)
+        elif not is_batch:
+            download_audiobook(odm_filenames[0], pool=pool, **download_options)
+        else:
+            report = download_audiobooks(odm_filenames, pool,
+                    resume_queue=True, **download_options)
+            report.print_summary()
+            if report.failures or report.skipped:
+                sys.exit(1)